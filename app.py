@@ -1,18 +1,19 @@
 import os
+import time
+import llm
+import metrics
 import mondayPPP
-from flask import Flask, render_template, request
-from werkzeug.utils import secure_filename
+from config import JOB_WORKERS, JOB_RESULT_TTL, TIMING_FOOTER
+from flask import Flask, Response, jsonify, make_response, render_template, request, stream_with_context, url_for
 from flask_cors import CORS
+from jobs import JobQueue, job_key
+from workbook import board_name
 
 
 app = Flask(__name__)
 CORS(app)  # handle cors issues
 
-# Configuration for file uploads
-UPLOAD_FOLDER = os.path.join(os.getcwd(), 'uploads')  # Folder to store uploaded files
-if not os.path.exists(UPLOAD_FOLDER):  # create directory for uploads if DNE
-    os.makedirs(UPLOAD_FOLDER)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+job_queue = JobQueue(workers=JOB_WORKERS, result_ttl=JOB_RESULT_TTL)  # background PPP generations
 
 
 # render interface for Excel upload and text input
@@ -21,7 +22,38 @@ def index():
     return render_template('index.html')
 
 
+# prometheus metrics: time per PPP stage, openai latency, tokens and retries, cache hits
+@app.route('/metrics')
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+# readiness check -- whether openai is reachable (result is cached, see HEALTH_CHECK_TTL)
+@app.route('/healthz')
+def healthz():
+    health = llm.check_connectivity()
+    return jsonify(health), 200 if health['ok'] else 503
+
+
+def job_status(job):
+    """what the job endpoints report about a job"""
+    return {
+        'job_id': job['id'],
+        'status': job['status'],  # queued, running, done or failed
+        'error': job['error'],
+        'status_url': url_for('get_job', job_id=job['id']),
+        'result_url': url_for('get_job_result', job_id=job['id'])
+    }
+
+
+def report_url(workbook, audience, sheet_name):
+    """stable url of a generated report, None when it wasn't cached (see mondayPPP.store_report)"""
+    key = mondayPPP.report_key(workbook, audience, sheet_name or None)
+    return url_for('get_report', key=key) if mondayPPP.has_report(key) else None
+
+
 # create a PPP for Excel upload and text input
+# (with ?async=1 the PPP is generated in the background and the job's status is returned right away)
 @app.route('/generatePPP', methods=['POST'])
 def generate_ppp():
     try:
@@ -41,35 +73,133 @@ def generate_ppp():
         if not audience:
             return render_template('index.html', error='Select an audience for your PPP')
 
-        # process uploaded file
+        # delta=1 only asks openai about tasks changed since the board's last delta run and lists the changes
+        # (board defaults to the export's file name without Monday's timestamp)
+        if request.form.get('delta') == '1':
+            generate = mondayPPP.create_ppp_delta
+            options = {'board': request.form.get('board') or board_name(file.filename)}
+        else:
+            generate = mondayPPP.create_ppp
+            options = {}
+
+        # queue the PPP and let the client poll /jobs/<job_id> for it
+        if request.args.get('async') == '1':
+            workbook = file.read()
+            key = job_key(workbook, sheet_name, audience, options.get('board'))
+            job, deduplicated = job_queue.submit(key, generate, workbook, audience=audience, pg=sheet_name or None,
+                                                 **options)
+            return jsonify(dict(job_status(job), deduplicated=deduplicated)), 202
+
+        # process uploaded file -- parsed from memory, so concurrent uploads with the same name can't collide
         if file:
-            # temporarily save the file to a secure location (uploads folder)
-            filename = secure_filename(file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(file_path)
+            workbook = file.read()
 
             # Generate PPP report
-            if sheet_name:  # sheet name was provided
-                progress_output, plans_output, problems_output = mondayPPP.create_ppp(file_path,
-                                                                                      audience=audience,
-                                                                                      pg=sheet_name)
-            else:  # sheet name was not provided
-                progress_output, plans_output, problems_output = mondayPPP.create_ppp(file_path,
-                                                                                      audience=audience)
-
-            # remove file from secure location once PPP is generated
-            os.remove(file_path)
+            start = time.perf_counter()
+            with metrics.timings() as stages:
+                report = generate(workbook, audience=audience, pg=sheet_name or None, **options)
 
             # Render PPP report or pass it to a new template
-            return render_template('index.html',
-                                   progress_output=progress_output,
-                                   plans_output=plans_output,
-                                   problems_output=problems_output)
+            return render_template('index.html', **mondayPPP.report_outputs(report),
+                                   report_url=None if options else report_url(workbook, audience, sheet_name),
+                                   timings=metrics.describe(stages, time.perf_counter() - start)
+                                   if TIMING_FOOTER else None)
 
     except Exception as e:  # error occurred
         return render_template('index.html', error=str(e))
 
 
+# create a PPP for every sheet and audience asked for from one Excel upload
+# (form fields: excel_file, one or more audience, zero or more sheet_name) -- returns all reports as JSON
+@app.route('/generatePPP/batch', methods=['POST'])
+def generate_ppp_batch():
+    file = request.files.get('excel_file')  # retrieve Excel file from POST request
+    audiences = [audience for audience in request.form.getlist('audience') if audience]
+    sheet_names = [sheet_name.strip() for sheet_name in request.form.getlist('sheet_name') if sheet_name.strip()]
+
+    if not file or file.filename == '':
+        return jsonify(error='Select an Excel file to create a PPP'), 400
+    if not audiences:
+        return jsonify(error='Select an audience for your PPP'), 400
+
+    try:
+        reports = mondayPPP.create_ppp_bundle(file.read(), audiences=audiences, sheets=sheet_names or None)
+        return jsonify(reports=reports)
+    except Exception as e:  # error occurred
+        return jsonify(error=str(e)), 500
+
+
+# status of a background PPP generation
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify(error='Unknown or expired job'), 404
+    return jsonify(job_status(job))
+
+
+# finished PPP of a background generation
+@app.route('/jobs/<job_id>/result')
+def get_job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return render_template('index.html', error='This PPP is no longer available, generate it again'), 404
+    if job['status'] == 'failed':
+        return render_template('index.html', error=job['error'])
+    if job['status'] != 'done':
+        return jsonify(job_status(job)), 202
+    return render_template('index.html', **mondayPPP.report_outputs(job['result']))
+
+
+# a generated PPP at a stable url, for as long as it is cached -- revalidated with ETag/If-None-Match
+@app.route('/reports/<key>')
+def get_report(key):
+    report = mondayPPP.cached_report(key)
+    if report is None:
+        return render_template('index.html', error='This PPP is no longer available, generate it again'), 404
+    if report['etag'] in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = make_response(render_template('index.html', **mondayPPP.report_outputs(report['outputs']),
+                                                 report_url=request.path))
+    response.set_etag(report['etag'])
+    response.headers['Cache-Control'] = 'no-cache'  # may be stored, but revalidated every time
+    return response
+
+
+# create a PPP for Excel upload and text input, streaming tasks as Server-Sent Events as soon as their batch
+# (LLM_BATCH_SIZE tasks, one openai call) is formatted:
+# - 'task': {section, html, date, elapsed_ms} in the order batches finish
+# - 'report': {progress_output, plans_output, problems_output, elapsed_ms, timings (with TIMING_FOOTER),
+#   report_url (once cached)} with every section sorted by target date
+# - 'error': {error}
+@app.route('/generatePPP/stream', methods=['POST'])
+def generate_ppp_stream():
+    file = request.files.get('excel_file')  # retrieve Excel file from POST request
+    audience = request.form.get('audience')  # retrieve selected dropdown value from POST request
+    sheet_name = request.form.get('sheet_name')  # retrieve text input from POST request
+
+    if not file or file.filename == '':
+        return jsonify(error='Select an Excel file to create a PPP'), 400
+    if not audience:
+        return jsonify(error='Select an audience for your PPP'), 400
+
+    workbook = file.read()
+
+    def events():
+        report_events = mondayPPP.ReportEvents()
+        try:
+            with metrics.timings() as stages:
+                for frame in mondayPPP.stream_ppp(workbook, audience=audience, pg=sheet_name or None):
+                    url = report_url(workbook, audience, sheet_name) if frame[0] == 'report' else None
+                    yield report_events.event(frame, stages, report_url=url)
+        except Exception as e:  # error occurred
+            yield report_events.error(e)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})  # don't let proxies buffer
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
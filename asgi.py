@@ -0,0 +1,159 @@
+import asyncio
+import time
+import llm
+import metrics
+import mondayPPP
+from config import TIMING_FOOTER
+from quart import Quart, Response, jsonify, render_template, request, url_for
+from quart_cors import cors
+from workbook import board_name
+
+# the async server: the routes of app.py served from one event loop, e.g. hypercorn asgi:app
+# a report waiting on openai holds no worker, so one process generates many reports at once
+# (Excel parsing still runs on worker threads, see mondayPPP.create_ppp_async)
+app = cors(Quart(__name__))  # handle cors issues
+
+
+# render interface for Excel upload and text input
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+
+# prometheus metrics: time per PPP stage, openai latency, tokens and retries, cache hits
+@app.route('/metrics')
+async def get_metrics():
+    return Response(await asyncio.to_thread(metrics.render), mimetype='text/plain; version=0.0.4')  # reads cache stats
+
+
+# readiness check -- whether openai is reachable (result is cached, see HEALTH_CHECK_TTL)
+@app.route('/healthz')
+async def healthz():
+    health = await asyncio.to_thread(llm.check_connectivity)
+    return jsonify(health), 200 if health['ok'] else 503
+
+
+def cached_report_key(workbook, audience, sheet_name):
+    """key of a generated report, None when it wasn't cached (see mondayPPP.store_report)"""
+    key = mondayPPP.report_key(workbook, audience, sheet_name or None)
+    return key if mondayPPP.has_report(key) else None
+
+
+async def report_url(workbook, audience, sheet_name):
+    """stable url of a generated report, None when it wasn't cached -- the cache is read on a worker thread"""
+    key = await asyncio.to_thread(cached_report_key, workbook, audience, sheet_name)
+    return url_for('get_report', key=key) if key is not None else None
+
+
+# create a PPP for Excel upload and text input
+@app.route('/generatePPP', methods=['POST'])
+async def generate_ppp():
+    try:
+        files = await request.files
+        form = await request.form
+
+        # no file upload in POST request
+        if 'excel_file' not in files:
+            return await render_template('index.html', error='Include an Excel file to create a PPP')
+
+        file = files['excel_file']  # retrieve Excel file from POST request
+        audience = form.get('audience')  # retrieve selected dropdown value from POST request
+        sheet_name = form.get('sheet_name')  # retrieve text input from POST request
+
+        # checking if uploaded file upload is empty
+        if file.filename == '':
+            return await render_template('index.html', error='Select an Excel file to create a PPP')
+
+        # checking if audience is selected
+        if not audience:
+            return await render_template('index.html', error='Select an audience for your PPP')
+
+        workbook = file.read()
+        delta = form.get('delta') == '1'
+        start = time.perf_counter()
+        with metrics.timings() as stages:
+            if delta:  # delta PPPs keep the threaded pipeline, see create_ppp_delta
+                report = await asyncio.to_thread(mondayPPP.create_ppp_delta, workbook, audience=audience,
+                                                 board=form.get('board') or board_name(file.filename),
+                                                 pg=sheet_name or None)
+            else:
+                report = await mondayPPP.create_ppp_async(workbook, audience=audience, pg=sheet_name or None)
+
+        # Render PPP report or pass it to a new template
+        return await render_template('index.html', **mondayPPP.report_outputs(report),
+                                     report_url=None if delta else await report_url(workbook, audience, sheet_name),
+                                     timings=metrics.describe(stages, time.perf_counter() - start)
+                                     if TIMING_FOOTER else None)
+
+    except Exception as e:  # error occurred
+        return await render_template('index.html', error=str(e))
+
+
+# create a PPP for every sheet and audience asked for from one Excel upload, see app.py
+@app.route('/generatePPP/batch', methods=['POST'])
+async def generate_ppp_batch():
+    files = await request.files
+    form = await request.form
+    file = files.get('excel_file')  # retrieve Excel file from POST request
+    audiences = [audience for audience in form.getlist('audience') if audience]
+    sheet_names = [sheet_name.strip() for sheet_name in form.getlist('sheet_name') if sheet_name.strip()]
+
+    if not file or file.filename == '':
+        return jsonify(error='Select an Excel file to create a PPP'), 400
+    if not audiences:
+        return jsonify(error='Select an audience for your PPP'), 400
+
+    try:
+        reports = await asyncio.to_thread(mondayPPP.create_ppp_bundle, file.read(), audiences=audiences,
+                                          sheets=sheet_names or None)
+        return jsonify(reports=reports)
+    except Exception as e:  # error occurred
+        return jsonify(error=str(e)), 500
+
+
+# a generated PPP at a stable url, for as long as it is cached -- revalidated with ETag/If-None-Match
+@app.route('/reports/<key>')
+async def get_report(key):
+    report = await asyncio.to_thread(mondayPPP.cached_report, key)
+    if report is None:
+        return await render_template('index.html', error='This PPP is no longer available, generate it again'), 404
+    if report['etag'] in request.if_none_match:
+        response = Response('', status=304)
+    else:
+        response = Response(await render_template('index.html', **mondayPPP.report_outputs(report['outputs']),
+                                                  report_url=request.path), mimetype='text/html')
+    response.set_etag(report['etag'])
+    response.headers['Cache-Control'] = 'no-cache'  # may be stored, but revalidated every time
+    return response
+
+
+# create a PPP for Excel upload and text input, streaming tasks as Server-Sent Events batch by batch, see app.py
+@app.route('/generatePPP/stream', methods=['POST'])
+async def generate_ppp_stream():
+    files = await request.files
+    form = await request.form
+    file = files.get('excel_file')  # retrieve Excel file from POST request
+    audience = form.get('audience')  # retrieve selected dropdown value from POST request
+    sheet_name = form.get('sheet_name')  # retrieve text input from POST request
+
+    if not file or file.filename == '':
+        return jsonify(error='Select an Excel file to create a PPP'), 400
+    if not audience:
+        return jsonify(error='Select an audience for your PPP'), 400
+
+    workbook = file.read()
+    key = await asyncio.to_thread(mondayPPP.report_key, workbook, audience, sheet_name or None)
+    url = url_for('get_report', key=key)  # while there's a request context
+
+    async def events():
+        report_events = mondayPPP.ReportEvents()
+        try:
+            with metrics.timings() as stages:
+                async for frame in mondayPPP.stream_ppp_async(workbook, audience=audience, pg=sheet_name or None):
+                    cached = frame[0] == 'report' and await asyncio.to_thread(mondayPPP.has_report, key)
+                    yield report_events.event(frame, stages, report_url=url if cached else None)
+        except Exception as e:  # error occurred
+            yield report_events.error(e)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})  # don't let proxies buffer
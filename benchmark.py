@@ -0,0 +1,427 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import httpx
+import numpy as np
+import pandas as pd
+import fakeopenai
+import mondayPPP
+from config import LLM_BATCH_SIZE
+from synthetic import board_frame, timeline_cells, write_workbook
+
+
+def legacy_select_tasks(df, audience):
+    """select_tasks before classify_tasks: one boolean mask per section and iterrows"""
+    df = df[~df['Name'].isna() &
+            (df['Name'].str.strip() != '') &
+            (df['Name'].str.strip() != 'Subitems') &
+            (df['Name'].str.strip() != 'Name') &
+            (df['Name'].str.strip() != 'Review') &
+            (df['Name'].str.strip() != 'Closed')]
+    if audience != 'Everyone':
+        df = df[df['Audience'].str.strip() == audience]
+    df = df.assign(**{'Timeline': mondayPPP.parse_timelines(df['Timeline']),
+                      'Completed Date': pd.to_datetime(df['Completed Date'], format='%m/%d/%Y', errors='coerce')})
+
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    last_week = today - timedelta(days=7)
+    two_months = today + timedelta(days=60)
+    progress_section = df[(df['Status'] == 'Completed') &
+                          (df['Completed Date'] >= last_week) &
+                          (df['Completed Date'] <= today)]
+    plan_section = df[((df['Status'] == 'Working') |
+                      (df['Status'] == 'Committed') |
+                      (df['Status'] == 'Completed - Partial')) &
+                      ((df['Timeline'] > today) &
+                      (df['Timeline'] <= two_months))]
+    blocked_section = df[df['Status'] == 'Blocked']
+    overdue_section = df[(df['Timeline'] <= today) &
+                         (df['Status'] != 'Completed') &
+                         (df['Status'] != 'Soft Commit') &
+                         (df['Status'] != 'Deprioritized') &
+                         (df['Status'] != 'Canceled') &
+                         (df['Status'] != 'Review') &
+                         (df['Status'] != 'Blocked')]
+    return ([('progress', row, {}) for index, row in progress_section.iterrows()] +
+            [('plan', row, {}) for index, row in plan_section.iterrows()] +
+            [('problems', row, {'is_blocked': True}) for index, row in blocked_section.iterrows()] +
+            [('problems', row, {'is_overdue': True}) for index, row in overdue_section.iterrows()])
+
+
+def current_select_tasks(df, audience):
+    """read_sheet's row filter followed by select_tasks (audience filter, date parsing and sections)"""
+    return mondayPPP.select_tasks(mondayPPP.normalize_sheet(df), audience)[0]
+
+
+def best_time(fn, repeat):
+    """fastest of repeat runs, in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_timeline(row_counts, repeat):
+    """per-cell to_datetime apply vs vectorized parse_timelines"""
+    print(f"{'rows':>8} {'apply (s)':>10} {'vectorized (s)':>15} {'speedup':>8}")
+    for rows in row_counts:
+        timelines = timeline_cells(rows)
+        # cells without a ' - ' range parse the same both ways. ranges don't: to_datetime read an ISO range as its
+        # start date at a bogus utc offset ('2024-06-03 - 2024-06-20' -> 2024-06-03 20:24 UTC-20:00, which can't be
+        # compared with today) and other ranges as NaT, parse_timelines gives their end date
+        comparable = ~timelines.fillna('').str.contains(' - ')
+        pd.testing.assert_series_equal(timelines[comparable].apply(mondayPPP.to_datetime),
+                                       mondayPPP.parse_timelines(timelines)[comparable], check_names=False)
+        per_cell = best_time(lambda: timelines[comparable].apply(mondayPPP.to_datetime), repeat)
+        vectorized = best_time(lambda: mondayPPP.parse_timelines(timelines[comparable]), repeat)
+        print(f"{rows:>8} {per_cell:>10.3f} {vectorized:>15.3f} {per_cell / vectorized:>7.1f}x")
+
+
+def peak_memory(fn):
+    """peak python memory allocated while running fn, in MB"""
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def bench_classify(row_counts, repeat, audience):
+    """row filter, section masks and iterrows vs categorical single-pass classify_tasks and records"""
+    print(f"{'rows':>8} {'tasks':>7} {'masks (s)':>10} {'single pass (s)':>16} "
+          f"{'masks (MB)':>11} {'single pass (MB)':>17}")
+    for rows in row_counts:
+        df = board_frame(rows)
+        legacy = legacy_select_tasks(df, audience)
+        current = current_select_tasks(df, audience)
+        # same tasks in the same sections and order
+        assert [(job[0], job[1]['Name'], job[2]) for job in legacy] == \
+               [(job[0], job[1]['Name'], job[2]) for job in current]
+        masks = best_time(lambda: legacy_select_tasks(df, audience), repeat)
+        single_pass = best_time(lambda: current_select_tasks(df, audience), repeat)
+        masks_memory = peak_memory(lambda: legacy_select_tasks(df, audience))
+        single_pass_memory = peak_memory(lambda: current_select_tasks(df, audience))
+        print(f"{rows:>8} {len(current):>7} {masks:>10.3f} {single_pass:>16.3f} "
+              f"{masks_memory:>11.1f} {single_pass_memory:>17.1f}")
+
+
+def percentiles(times):
+    """p50, p95 and p99 of times, in seconds"""
+    return tuple(np.percentile(times, [50, 95, 99]))
+
+
+def clear_caches():
+    """drops formatted tasks, parsed sheets and finished reports, so the next run starts cold"""
+    mondayPPP.task_cache.clear()
+    mondayPPP.sheet_cache.clear()
+    mondayPPP.report_cache.clear()
+
+
+def time_stages(data, audience, batch_size):
+    """seconds spent in each stage of create_ppp for one run on the workbook contents data"""
+    stages = {}
+
+    def stage(name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        stages[name] = time.perf_counter() - start
+        return result
+
+    df = stage('read_excel', mondayPPP.parse_sheet, data)
+    df = stage('filter rows', mondayPPP.normalize_sheet, df)
+    df = stage('parse dates', mondayPPP.audience_tasks, df, audience)
+    jobs = stage('select sections', lambda: mondayPPP.section_jobs(
+        df, mondayPPP.classify_tasks(df['Status'], df['Timeline'], df['Completed Date'])))
+    has_og_target_date = 'Original Target Date' in df.columns
+    has_comments = 'Comments' in df.columns
+    tasks = stage('llm fan-out', mondayPPP.summarize_tasks,
+                  {str(i): mondayPPP.task_prompt(job[1]) for i, job in enumerate(jobs)}, batch_size=batch_size)
+    stage('assemble html', lambda: mondayPPP.assemble_ppp(jobs, [
+        mondayPPP.decorate_task(job[1], tasks[str(i)], has_og_target_date, has_comments, **job[2])
+        for i, job in enumerate(jobs)]))
+    stages['tasks'] = len(jobs)
+    return stages
+
+
+def bench_pipeline(workbook, rows, iterations, audience, batch_size, cold):
+    """per-stage timings of create_ppp, then p50/p95/p99 of create_ppp and of the /generatePPP route,
+    against whatever openai OPENAI_BASE_URL points at (see e2e for a local fake)"""
+    from app import app  # after mondayPPP, like gunicorn would
+
+    data = open(workbook, 'rb').read() if workbook else write_workbook(rows)
+    client = app.test_client()
+
+    def post():
+        response = client.post('/generatePPP', data={'excel_file': (io.BytesIO(data), 'board.xlsx'),
+                                                     'audience': audience}, content_type='multipart/form-data')
+        assert response.status_code == 200, response.status_code
+
+    runs = {'stages': [], 'create_ppp': [], '/generatePPP': []}
+    for name, fn in [('stages', lambda: time_stages(data, audience, batch_size)),
+                     ('create_ppp', lambda: mondayPPP.create_ppp(data, audience, batch_size=batch_size)),
+                     ('/generatePPP', post)]:
+        for _ in range(iterations):
+            if cold:
+                clear_caches()
+            with contextlib.redirect_stdout(io.StringIO()):  # the pipeline prints every task
+                start = time.perf_counter()
+                result = fn()
+                elapsed = time.perf_counter() - start
+            runs[name].append(result if name == 'stages' else elapsed)
+
+    print(f"{len(data) / 1024:.0f} KB workbook, {runs['stages'][0]['tasks']} reported tasks, audience {audience}, "
+          f"batch size {batch_size}, {'cold' if cold else 'warm'} caches, {iterations} iteration(s)")
+    print(f"{'stage':<16} {'median (s)':>11} {'max (s)':>9}")
+    for stage in [stage for stage in runs['stages'][0] if stage != 'tasks']:
+        times = [run[stage] for run in runs['stages']]
+        print(f"{stage:<16} {np.median(times):>11.3f} {max(times):>9.3f}")
+    print(f"{'end to end':<16} {'p50 (s)':>11} {'p95 (s)':>9} {'p99 (s)':>9}")
+    for name in ['create_ppp', '/generatePPP']:
+        print(f"{name:<16} {percentiles(runs[name])[0]:>11.3f} {percentiles(runs[name])[1]:>9.3f} "
+              f"{percentiles(runs[name])[2]:>9.3f}")
+
+
+def bench_cold_start(repeat):
+    """seconds to start a python process and import the app, the share of a worker (re)start we control"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import app'], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        times.append(time.perf_counter() - start)
+    return percentiles(times)
+
+
+def bench_e2e(args):
+    """the whole pipeline offline: a synthetic workbook, a fake openai server in this process and the
+    pipeline benchmark in a child process, so serving fake completions doesn't compete for its GIL"""
+    with tempfile.TemporaryDirectory() as scratch:
+        workbook = os.path.join(scratch, 'board.xlsx')
+        write_workbook(args.rows, path=workbook)
+        server = fakeopenai.start(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                                  retry_after=args.retry_after, slow_rate=args.slow_rate,
+                                  slow_latency=args.slow_latency)
+        print(f"fake openai: {args.latency:.2f}s +/- {args.jitter:.2f}s per completion "
+              f"({args.slow_rate:.0%} take {args.slow_latency:.0f}s), {args.rate_limit:.0%} answered with 429")
+        print(f"cold start (import app): p50 {bench_cold_start(args.repeat)[0]:.3f}s")
+        env = dict(os.environ, OPENAI_BASE_URL=server.url, OPENAI_API_KEY='fake',
+                   PPP_CACHE_DIR=os.path.join(scratch, 'cache'))  # never touches the real cache
+        command = [sys.executable, os.path.abspath(__file__), 'pipeline', '--workbook', workbook,
+                   '--iterations', str(args.iterations), '--audience', args.audience,
+                   '--batch-size', str(args.batch_size)]
+        subprocess.run(command + ([] if args.warm else ['--cold']), check=True, env=env)
+        print(f"fake openai served {server.requests} completion(s), {server.rate_limited} rate limited")
+        server.shutdown()
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+def tree_rss(pid):
+    """resident memory of a process and its children in MB (read from /proc, None where there is none)"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            rss = next(int(line.split()[1]) for line in status if line.startswith('VmRSS')) / 1024
+        with open(f"/proc/{pid}/task/{pid}/children") as children:
+            return rss + sum(tree_rss(int(child)) or 0 for child in children.read().split())
+    except (OSError, StopIteration):
+        return None
+
+
+def serve(server, workers, env):
+    """starts the sync app (gunicorn sync workers) or the async app (one hypercorn process) in a child
+    process -- returns it and its url once it answers"""
+    port = free_port()
+    if server == 'sync':
+        command = ['gunicorn', 'app:app', '--workers', str(workers), '--timeout', '300']
+    else:
+        command = ['hypercorn', 'asgi:app', '--workers', '1']
+    process = subprocess.Popen([sys.executable, '-m'] + command + ['--bind', f"127.0.0.1:{port}"],
+                               cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        try:
+            httpx.get(f"{url}/metrics", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{server} server didn't start")
+
+
+def load(url, workbooks, concurrency, audience):
+    """posts every workbook to /generatePPP from concurrency clients at once -- returns the seconds it took,
+    every request's latency and the number of tasks formatted locally (openai answers missing)"""
+    def post(data):
+        start = time.perf_counter()
+        response = client.post(f"{url}/generatePPP", files={'excel_file': ('board.xlsx', data)},
+                               data={'audience': audience})
+        assert response.status_code == 200, response.status_code
+        return time.perf_counter() - start, response.text.count("class='fallback'")
+
+    with httpx.Client(timeout=600, limits=httpx.Limits(max_connections=concurrency)) as client, \
+            ThreadPoolExecutor(max_workers=concurrency) as clients:
+        start = time.perf_counter()
+        results = list(clients.map(post, workbooks))
+        elapsed = time.perf_counter() - start
+    return elapsed, [latency for latency, _ in results], sum(fallbacks for _, fallbacks in results)
+
+
+def bench_load(args):
+    """requests per second the sync app (gunicorn sync workers) and the async app (one hypercorn process)
+    sustain with concurrency clients posting workbooks, against a local fake openai. every workbook is
+    different and every server gets an empty cache, so each report asks openai for all of its tasks"""
+    workbooks = [write_workbook(args.rows, seed=seed) for seed in range(args.requests)]
+    fake = fakeopenai.start(latency=args.latency, jitter=args.jitter)
+    print(f"{args.requests} different {args.rows} task workbooks from {args.concurrency} concurrent clients, "
+          f"fake openai {args.latency:.2f}s +/- {args.jitter:.2f}s per completion, batch size {args.batch_size}, "
+          f"LLM_MAX_IN_FLIGHT {args.max_in_flight}")
+    print(f"{'server':<26} {'req/s':>7} {'p50 (s)':>8} {'p95 (s)':>8} {'fallbacks':>10} {'rss (MB)':>9}")
+    with tempfile.TemporaryDirectory() as scratch:
+        for server in args.servers:
+            env = dict(os.environ, OPENAI_BASE_URL=fake.url, OPENAI_API_KEY='fake',
+                       PPP_CACHE_DIR=os.path.join(scratch, server),  # cold, and never the real cache
+                       LLM_BATCH_SIZE=str(args.batch_size), LLM_MAX_IN_FLIGHT=str(args.max_in_flight),
+                       LLM_REQUESTS_PER_MINUTE='1000000', LLM_TOKENS_PER_MINUTE='1000000000')  # the fake has no quota
+            process, url = serve(server, args.sync_workers, env)
+            try:
+                elapsed, latencies, fallbacks = load(url, workbooks, args.concurrency, args.audience)
+                rss = tree_rss(process.pid)
+            finally:
+                process.terminate()
+                process.wait()
+            name = f"sync ({args.sync_workers} gunicorn workers)" if server == 'sync' else 'async (1 hypercorn process)'
+            print(f"{name:<26} {args.requests / elapsed:>7.2f} {percentiles(latencies)[0]:>8.2f} "
+                  f"{percentiles(latencies)[1]:>8.2f} {fallbacks:>10} "
+                  f"{'' if rss is None else f'{rss:.0f}':>9}")
+    fake.shutdown()
+
+
+def peak_rss():
+    """peak resident memory of this process so far, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def ingest_child(mode, path, audience):
+    """reads the workbook at path in a fresh process, with the whole sheet path (sheet: read_excel, normalize,
+    select) or the streaming one (stream: stream_tasks), and prints its memory and time as json"""
+    with open(path, 'rb') as workbook_file:
+        data = workbook_file.read()
+    baseline = peak_rss()  # the interpreter, pandas and the workbook's bytes
+    start = time.perf_counter()
+    if mode == 'sheet':
+        jobs = mondayPPP.select_tasks(mondayPPP.normalize_sheet(mondayPPP.parse_sheet(data)), audience)[0]
+    else:
+        jobs = mondayPPP.stream_tasks(data, audience)[0]
+    print(json.dumps({'seconds': time.perf_counter() - start, 'peak_mb': peak_rss() - baseline,
+                      'tasks': len(jobs)}))
+
+
+def bench_ingest(row_counts, audience):
+    """peak memory (above the process baseline) and time of reading a synthetic board export with rows tasks,
+    whole sheet vs streaming -- each run in its own process, so every peak is its own"""
+    print(f"{'rows':>8} {'size (MB)':>10} {'tasks':>7} {'sheet peak (MB)':>16} {'stream peak (MB)':>17} "
+          f"{'sheet (s)':>10} {'stream (s)':>11}")
+    with tempfile.TemporaryDirectory() as scratch:
+        for rows in row_counts:
+            path = os.path.join(scratch, f"board-{rows}.xlsx")
+            write_workbook(rows, path=path)
+            runs = {}
+            for mode in ['sheet', 'stream']:
+                child = subprocess.run([sys.executable, os.path.abspath(__file__), 'ingest', '--child', mode, path,
+                                        '--audience', audience], check=True, capture_output=True, text=True,
+                                       env=dict(os.environ, PPP_CACHE_DIR=os.path.join(scratch, 'cache')))
+                runs[mode] = json.loads(child.stdout.strip().splitlines()[-1])
+            print(f"{rows:>8} {os.path.getsize(path) / 1024 / 1024:>10.1f} {runs['stream']['tasks']:>7} "
+                  f"{runs['sheet']['peak_mb']:>16.1f} {runs['stream']['peak_mb']:>17.1f} "
+                  f"{runs['sheet']['seconds']:>10.2f} {runs['stream']['seconds']:>11.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks for the PPP pipeline')
+    subcommands = parser.add_subparsers(dest='benchmark', required=True)
+    timeline = subcommands.add_parser('timeline', help='Timeline column parsing')
+    timeline.add_argument('--rows', type=int, nargs='+', default=[10000, 50000, 100000])
+    timeline.add_argument('--repeat', type=int, default=3)
+    classify = subcommands.add_parser('classify', help='row filtering and section selection')
+    classify.add_argument('--rows', type=int, nargs='+', default=[10000, 50000, 100000])
+    classify.add_argument('--repeat', type=int, default=3)
+    classify.add_argument('--audience', default='Everyone')
+    pipeline = subcommands.add_parser('pipeline', help='per-stage and end to end PPP latency, against '
+                                                       'the openai api OPENAI_BASE_URL points at')
+    pipeline.add_argument('--workbook', help='board export to use, a synthetic one when not given')
+    pipeline.add_argument('--rows', type=int, default=500, help='tasks in the synthetic workbook')
+    pipeline.add_argument('--iterations', type=int, default=5)
+    pipeline.add_argument('--audience', default='Everyone')
+    pipeline.add_argument('--batch-size', type=int, default=LLM_BATCH_SIZE)
+    pipeline.add_argument('--cold', action='store_true',
+                          help='clear the task and sheet caches before every run (point PPP_CACHE_DIR somewhere '
+                               'disposable)')
+    e2e = subcommands.add_parser('e2e', help='the pipeline benchmark offline, against a local fake openai')
+    e2e.add_argument('--rows', type=int, default=500, help='tasks in the synthetic workbook')
+    e2e.add_argument('--iterations', type=int, default=5)
+    e2e.add_argument('--audience', default='Everyone')
+    e2e.add_argument('--batch-size', type=int, default=LLM_BATCH_SIZE)
+    e2e.add_argument('--warm', action='store_true', help='keep cached tasks and sheets between runs')
+    e2e.add_argument('--latency', type=float, default=0.5, help='seconds per fake completion')
+    e2e.add_argument('--jitter', type=float, default=0.2, help='+/- seconds per fake completion')
+    e2e.add_argument('--rate-limit', type=float, default=0.0, help='share of fake completions answered with 429')
+    e2e.add_argument('--retry-after', type=int, default=1, help='seconds sent with every fake 429')
+    e2e.add_argument('--slow-rate', type=float, default=0.0, help='share of fake completions that are very slow')
+    e2e.add_argument('--slow-latency', type=float, default=30, help='seconds a very slow fake completion takes')
+    e2e.add_argument('--repeat', type=int, default=3, help='cold starts to time')
+    load_test = subcommands.add_parser('load', help='throughput of the sync and the async server under concurrent '
+                                                    'requests, against a local fake openai')
+    load_test.add_argument('--servers', nargs='+', choices=['sync', 'async'], default=['sync', 'async'])
+    load_test.add_argument('--sync-workers', type=int, default=4, help='gunicorn workers of the sync server')
+    load_test.add_argument('--requests', type=int, default=64, help='reports generated, each from its own workbook')
+    load_test.add_argument('--concurrency', type=int, default=32, help='clients posting at once')
+    load_test.add_argument('--rows', type=int, default=100, help='tasks per workbook')
+    load_test.add_argument('--audience', default='Everyone')
+    load_test.add_argument('--batch-size', type=int, default=LLM_BATCH_SIZE)
+    load_test.add_argument('--max-in-flight', type=int, default=64, help='LLM_MAX_IN_FLIGHT of both servers')
+    load_test.add_argument('--latency', type=float, default=1.0, help='seconds per fake completion')
+    load_test.add_argument('--jitter', type=float, default=0.2, help='+/- seconds per fake completion')
+    ingest = subcommands.add_parser('ingest', help='peak memory of reading large board exports, whole sheet vs '
+                                                   'streaming')
+    ingest.add_argument('--rows', type=int, nargs='+', default=[10000, 50000, 100000])
+    ingest.add_argument('--audience', default='Everyone')
+    ingest.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.benchmark == 'timeline':
+        bench_timeline(args.rows, args.repeat)
+    elif args.benchmark == 'classify':
+        bench_classify(args.rows, args.repeat, args.audience)
+    elif args.benchmark == 'pipeline':
+        bench_pipeline(args.workbook, args.rows, args.iterations, args.audience, args.batch_size, args.cold)
+    elif args.benchmark == 'e2e':
+        bench_e2e(args)
+    elif args.benchmark == 'load':
+        bench_load(args)
+    elif args.benchmark == 'ingest':
+        if args.child:
+            ingest_child(*args.child, args.audience)
+        else:
+            bench_ingest(args.rows, args.audience)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import asyncio
+import atexit
+import hashlib
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+def normalize(value):
+    """json-friendly, order-independent form of a prompt value (NaN/NaT become None, strings are stripped)"""
+    if isinstance(value, dict):
+        return {str(key): normalize(item) for key, item in sorted(value.items(), key=lambda pair: str(pair[0]))}
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (bool, int, float)):
+        return value
+    if str(value) == 'NaT':
+        return None
+    return str(value)  # timestamps and anything else pandas hands us
+
+
+def content_key(*parts):
+    """sha256 of the normalized parts"""
+    payload = json.dumps(normalize(list(parts)), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class DiskCache:
+    """string values in a local SQLite file, evicted by age and then least-recently-used once
+    max_entries or max_bytes is exceeded. get_or_compute collapses concurrent identical
+    requests into one call of compute
+
+    the limits are enforced every EVICT_EVERY sets (at most a tenth of max_entries) or EVICT_INTERVAL
+    seconds rather than on every set, and the access times of hits are written TOUCH_EVERY at a time
+    (or every TOUCH_INTERVAL seconds), so neither a set nor a hit pays for a scan or a commit of its own"""
+
+    EVICT_EVERY = 100
+    EVICT_INTERVAL = 60
+    TOUCH_EVERY = 100
+    TOUCH_INTERVAL = 10
+
+    def __init__(self, path, max_entries, max_bytes, max_age):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age  # seconds
+        self.lock = threading.Lock()
+        self.connection = None  # opened on first use
+        self.in_flight = {}  # key -> Future of the call computing it
+        self.async_in_flight = {}  # key -> asyncio future of the coroutine computing it (see get_or_compute_async)
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0  # requests that waited on an identical in-flight call
+        self.async_collapsed = 0  # the same, on the async server's event loop
+        self.evict_every = max(1, min(self.EVICT_EVERY, max_entries // 10))
+        self.sets_since_evict = 0
+        self.evicted_at = None  # the first set in a process evicts
+        self.touched = {}  # key -> access time of a hit not written yet
+        self.touched_at = time.monotonic()
+        atexit.register(self.flush)
+
+    def connect(self):
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")  # gunicorn workers share the file
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries ("
+                                    "key TEXT PRIMARY KEY, value TEXT, size INTEGER, created REAL, accessed REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_created ON entries (created)")
+            self.connection.commit()
+        return self.connection
+
+    def lookup(self, key):
+        """value for key if present and not expired, without touching the hit/miss counts"""
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT value FROM entries WHERE key = ? AND created >= ?",
+                                     (key, now - self.max_age)).fetchone()
+            if row is None:
+                return None
+            self.touched[key] = now
+            if len(self.touched) >= self.TOUCH_EVERY or time.monotonic() - self.touched_at >= self.TOUCH_INTERVAL:
+                self.write_access_times(connection)
+                connection.commit()
+            return row[0]
+
+    def write_access_times(self, connection):
+        """writes the access times of the hits since the last write, in one statement"""
+        connection.executemany("UPDATE entries SET accessed = ? WHERE key = ?",
+                               [(accessed, key) for key, accessed in self.touched.items()])
+        self.touched.clear()
+        self.touched_at = time.monotonic()
+
+    def flush(self):
+        """writes the access times still held in memory, e.g. when the process exits"""
+        with self.lock:
+            if self.touched:
+                connection = self.connect()
+                self.write_access_times(connection)
+                connection.commit()
+
+    def get(self, key):
+        value = self.lookup(key)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            connection = self.connect()
+            connection.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                               (key, value, len(value.encode('utf-8')), now, now))
+            self.sets_since_evict += 1
+            if (self.evicted_at is None or self.sets_since_evict >= self.evict_every
+                    or time.monotonic() - self.evicted_at >= self.EVICT_INTERVAL):
+                self.write_access_times(connection)  # so recently read entries aren't taken for unused ones
+                self.evict(connection, now)
+            connection.commit()
+
+    def evict(self, connection, now):
+        """drops expired entries, then the least recently used ones until the cache fits its limits"""
+        self.sets_since_evict = 0
+        self.evicted_at = time.monotonic()
+        connection.execute("DELETE FROM entries WHERE created < ?", (now - self.max_age,))
+        entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+        excess_entries = max(0, entries - self.max_entries)
+        excess_bytes = max(0, size - self.max_bytes)
+        freed_entries = freed_bytes = 0
+        stale = []
+        for key, entry_size in connection.execute("SELECT key, size FROM entries ORDER BY accessed"):
+            if freed_entries >= excess_entries and freed_bytes >= excess_bytes:
+                break
+            stale.append((key,))
+            freed_entries += 1
+            freed_bytes += entry_size
+        connection.executemany("DELETE FROM entries WHERE key = ?", stale)
+
+    def get_or_compute(self, key, compute):
+        """cached value for key, otherwise compute() -- shared with any identical call already running"""
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = Future()
+            else:
+                self.collapsed += 1
+        if not owner:
+            return future.result()
+
+        try:
+            value = self.lookup(key)  # an identical call may have finished since get()
+            if value is None:
+                value = compute()
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as compute_error:
+            future.set_exception(compute_error)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+
+    async def get_or_compute_async(self, key, compute):
+        """get_or_compute for the async server: compute() returns an awaitable, and identical requests
+        on the event loop wait on it without holding a thread"""
+        while True:
+            value = await asyncio.to_thread(self.get, key)  # sqlite and self.lock stay off the loop
+            if value is not None:
+                return value
+            future = self.async_in_flight.get(key)
+            if future is None:
+                break
+            self.async_collapsed += 1  # only touched on the event loop, so it needs no lock
+            try:
+                return await asyncio.shield(future)  # a waiter that gives up doesn't cancel it for the others
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the request computing it went away, compute it here instead
+
+        future = self.async_in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await asyncio.to_thread(self.lookup, key)  # another worker may have finished it since get()
+            if value is None:
+                value = await compute()
+                await asyncio.to_thread(self.set, key, value)
+            future.set_result(value)
+            return value
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as compute_error:
+            future.set_exception(compute_error)
+            future.exception()  # retrieved, in case nobody else was waiting on it
+            raise
+        finally:
+            del self.async_in_flight[key]
+
+    def clear(self):
+        """drops every entry, e.g. to time cold runs"""
+        with self.lock:
+            connection = self.connect()
+            connection.execute("DELETE FROM entries")
+            connection.commit()
+            self.touched.clear()
+
+    def stats(self):
+        """hit/miss counts for this process plus the size of the shared cache file"""
+        with self.lock:
+            entries, size = self.connect().execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+            return {'hits': self.hits, 'misses': self.misses, 'collapsed': self.collapsed + self.async_collapsed,
+                    'entries': entries, 'bytes': size}
@@ -0,0 +1,222 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from jinja2 import Environment, FileSystemLoader
+import generatePPP
+import mondayPPP
+from config import LLM_BATCH_SIZE
+from llm import task_key
+
+WORKBOOK_EXTENSIONS = ('.xlsx', '.xls')
+templates = Environment(loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')),
+                        autoescape=True)
+
+
+def find_workbooks(patterns):
+    """the workbooks in every directory, glob or file given, in a stable order and each one once"""
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+        else:
+            matches = sorted(glob.glob(pattern)) or [pattern]  # a missing file fails on its own, later
+        for path in matches:
+            if path.lower().endswith(WORKBOOK_EXTENSIONS) and not os.path.basename(path).startswith('~$'):
+                if path not in paths:
+                    paths.append(path)
+    return paths
+
+
+def prepare_workbook(path, sheet, audiences):
+    """parses and classifies one workbook (in a worker process) -- returns {'reports': [(audience, jobs,
+    has_og_target_date, has_comments)], 'parse_seconds'}, or {'error', 'parse_seconds'} if it can't be read"""
+    start = time.perf_counter()
+    try:
+        df = mondayPPP.read_sheet(path, sheet)
+        reports = [(audience,) + mondayPPP.select_tasks(df, audience) for audience in audiences]
+        return {'reports': reports, 'parse_seconds': time.perf_counter() - start}
+    except Exception as workbook_error:
+        return {'error': f"{type(workbook_error).__name__}: {workbook_error}",
+                'parse_seconds': time.perf_counter() - start}
+
+
+def file_name(text):
+    """text made safe to use in a file name"""
+    return re.sub(r'[^\w.-]+', '_', text)
+
+
+def workbook_names(paths):
+    """{path: the name its reports are named after} -- the workbook's file name, plus a hash of its path when
+    another workbook in the run has the same name (e.g. exports of one board from different folders)"""
+    names = {path: file_name(os.path.splitext(os.path.basename(path))[0]) for path in paths}
+    counts = Counter(name.lower() for name in names.values())  # file systems may ignore case
+    return {path: name if counts[name.lower()] == 1 else
+            f"{name}-{hashlib.sha256(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]}"
+            for path, name in names.items()}
+
+
+def report_name(workbook_name, sheet, audience):
+    """file name (without extension) of a workbook's report, workbook_name from workbook_names"""
+    return file_name('-'.join(part for part in [workbook_name, sheet, audience] if part))
+
+
+def write_report(out_dir, path, workbook_name, sheet, audience, report, seconds):
+    """writes a report as html and json -- returns the two file paths"""
+    progress_output, plans_output, problems_output = report
+    name = os.path.join(out_dir, report_name(workbook_name, sheet, audience))
+    with open(f"{name}.html", 'w', encoding='utf-8') as html_file:
+        html_file.write(templates.get_template('report.html').render(
+            workbook=os.path.basename(path), sheet=sheet, audience=audience, progress_output=progress_output,
+            plans_output=plans_output, problems_output=problems_output))
+    with open(f"{name}.json", 'w', encoding='utf-8') as json_file:
+        json.dump({'workbook': path, 'sheet': sheet, 'audience': audience, 'progress_output': progress_output,
+                   'plans_output': plans_output, 'problems_output': problems_output,
+                   'seconds': round(seconds, 3)}, json_file, indent=2)
+    return [f"{name}.html", f"{name}.json"]
+
+
+def summarize_workbooks(prepared, batch_size):
+    """formats the tasks of every prepared workbook -- all of them in one fan-out through the shared dispatcher,
+    each distinct task once. if that fails, each workbook is formatted on its own so only the workbooks with
+    failing tasks fail. returns ({task key: formatted task}, {path: error})"""
+    def prompts_of(results):
+        prompts = {}
+        for result in results:
+            for audience, jobs, has_og_target_date, has_comments in result['reports']:
+                for job in jobs:
+                    user_prompt = mondayPPP.task_prompt(job[1])
+                    prompts.setdefault(task_key(mondayPPP.SYSTEM_PROMPT, user_prompt), user_prompt)
+        return prompts
+
+    try:
+        return mondayPPP.summarize_tasks(prompts_of(prepared.values()), batch_size=batch_size), {}
+    except Exception as batch_error:
+        print(f"Error: {batch_error} -- formatting workbook by workbook")
+    tasks = {}
+    errors = {}
+    for path, result in prepared.items():
+        try:
+            tasks.update(mondayPPP.summarize_tasks(prompts_of([result]), batch_size=batch_size))
+        except Exception as workbook_error:
+            errors[path] = f"{type(workbook_error).__name__}: {workbook_error}"
+    return tasks, errors
+
+
+def run_batch(paths, audiences, sheet, out_dir, workers, batch_size):
+    """PPPs for every workbook and audience: workbooks are parsed and classified on a pool of processes,
+    then every task is formatted through this process's rate-limited dispatcher -- returns the summary"""
+    summary = {path: {'workbook': path, 'status': 'failed', 'error': None, 'parse_seconds': None, 'tasks': 0,
+                      'reports': []} for path in paths}
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {path: pool.submit(prepare_workbook, path, sheet, audiences) for path in paths}
+        prepared = {}
+        for path, future in futures.items():
+            try:
+                result = future.result()
+            except Exception as worker_error:  # e.g. the worker died
+                result = {'error': f"{type(worker_error).__name__}: {worker_error}", 'parse_seconds': None}
+            summary[path]['parse_seconds'] = result['parse_seconds']
+            if 'error' in result:
+                summary[path]['error'] = result['error']
+            else:
+                prepared[path] = result
+                summary[path]['tasks'] = sum(len(report[1]) for report in result['reports'])
+
+    start = time.perf_counter()
+    tasks, errors = summarize_workbooks(prepared, batch_size)
+    format_seconds = time.perf_counter() - start
+    for path, error in errors.items():
+        summary[path]['error'] = error
+
+    os.makedirs(out_dir, exist_ok=True)
+    names = workbook_names(paths)
+    for path, result in prepared.items():
+        if path in errors:
+            continue
+        try:
+            for audience, jobs, has_og_target_date, has_comments in result['reports']:
+                start = time.perf_counter()
+                formatted = [mondayPPP.decorate_task(
+                    job[1], tasks[task_key(mondayPPP.SYSTEM_PROMPT, mondayPPP.task_prompt(job[1]))],
+                    has_og_target_date, has_comments, **job[2]) for job in jobs]
+                report = mondayPPP.assemble_ppp(jobs, formatted)
+                summary[path]['reports'] += write_report(out_dir, path, names[path], sheet, audience, report,
+                                                         result['parse_seconds'] + time.perf_counter() - start)
+            summary[path]['status'] = 'done'
+        except Exception as report_error:
+            summary[path]['error'] = f"{type(report_error).__name__}: {report_error}"
+    return {'workbooks': list(summary.values()), 'format_seconds': format_seconds}
+
+
+def run_legacy(paths, sheet, out_dir, batch_size):
+    """PPPs for every workbook with generatePPP (the older board layout), one workbook after the other --
+    each one still formats its tasks concurrently through the shared dispatcher"""
+    os.makedirs(out_dir, exist_ok=True)
+    names = workbook_names(paths)
+    workbooks = []
+    for path in paths:
+        start = time.perf_counter()
+        summary = {'workbook': path, 'status': 'failed', 'error': None, 'parse_seconds': None, 'tasks': None,
+                   'reports': []}
+        report = generatePPP.create_ppp(path, sheet, batch_size=batch_size)
+        if isinstance(report, str):  # generatePPP returns its error message
+            summary['error'] = report
+        else:
+            summary['reports'] = write_report(out_dir, path, names[path], sheet, None, report,
+                                              time.perf_counter() - start)
+            summary['status'] = 'done'
+        workbooks.append(summary)
+    return {'workbooks': workbooks, 'format_seconds': None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generates PPPs for many Monday.com board exports at once')
+    parser.add_argument('workbooks', nargs='+', help='workbooks, directories of workbooks or globs')
+    parser.add_argument('--audience', action='append', help='audience to generate a PPP for, repeatable '
+                                                            '(default Everyone)')
+    parser.add_argument('--sheet', help='sheet to read from every workbook (default the first one)')
+    parser.add_argument('--out', default='reports', help='directory the html and json reports are written to')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes parsing workbooks')
+    parser.add_argument('--batch-size', type=int, default=LLM_BATCH_SIZE, help='tasks per openai call')
+    parser.add_argument('--legacy', action='store_true', help='workbooks use the older layout read by generatePPP')
+    args = parser.parse_args()
+
+    paths = find_workbooks(args.workbooks)
+    if not paths:
+        parser.error('no workbooks found')
+
+    start = time.perf_counter()
+    if args.legacy:
+        summary = run_legacy(paths, args.sheet, args.out, args.batch_size)
+    else:
+        summary = run_batch(paths, args.audience or ['Everyone'], args.sheet, args.out, args.workers,
+                            args.batch_size)
+    summary['total_seconds'] = time.perf_counter() - start
+    with open(os.path.join(args.out, 'summary.json'), 'w', encoding='utf-8') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+    failed = [workbook for workbook in summary['workbooks'] if workbook['status'] == 'failed']
+    print(f"\n{'workbook':<40} {'status':<7} {'tasks':>6} {'parse (s)':>10}")
+    for workbook in summary['workbooks']:
+        parse_seconds = '' if workbook['parse_seconds'] is None else f"{workbook['parse_seconds']:.2f}"
+        print(f"{os.path.basename(workbook['workbook'])[:40]:<40} {workbook['status']:<7} "
+              f"{'' if workbook['tasks'] is None else workbook['tasks']:>6} {parse_seconds:>10}")
+    if summary['format_seconds'] is not None:
+        print(f"formatting every task: {summary['format_seconds']:.2f}s")
+    print(f"{len(paths) - len(failed)} of {len(paths)} workbook(s) done in {summary['total_seconds']:.2f}s, "
+          f"reports in {args.out}")
+    for workbook in failed:
+        print(f"FAILED {workbook['workbook']}: {workbook['error']}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
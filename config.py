@@ -1,3 +1,56 @@
 import os
 
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')  # e.g. a local fakeopenai.py server, the openai api when unset
+HEALTH_CHECK_TTL = float(os.getenv('HEALTH_CHECK_TTL', 60))  # seconds a /healthz result is reused
+
+# pacing and retry settings for openai calls
+LLM_MAX_IN_FLIGHT = int(os.getenv('LLM_MAX_IN_FLIGHT', 8))  # concurrent completions per process
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 500))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 60000))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 5))  # retries on 429/5xx/connection errors
+LLM_BACKOFF_BASE = float(os.getenv('LLM_BACKOFF_BASE', 0.5))  # seconds, doubled on every retry
+LLM_BACKOFF_MAX = float(os.getenv('LLM_BACKOFF_MAX', 30))  # seconds
+LLM_BATCH_SIZE = int(os.getenv('LLM_BATCH_SIZE', 10))  # tasks per completion, 1 asks for every task separately
+LLM_BATCH_ROUNDS = int(os.getenv('LLM_BATCH_ROUNDS', 2))  # batch retries for tasks missing from a response
+LLM_CALL_TIMEOUT = float(os.getenv('LLM_CALL_TIMEOUT', 30))  # seconds before a completion is abandoned and retried
+LLM_HEDGE_AFTER = float(os.getenv('LLM_HEDGE_AFTER', 15))  # seconds before a slow completion is sent again, 0 never
+# seconds a report may take, tasks openai hasn't formatted by then are formatted locally (0 waits indefinitely)
+REPORT_DEADLINE = float(os.getenv('REPORT_DEADLINE', 90))
+
+# local cache of formatted tasks, reused while a task's fields and the prompt stay the same
+CACHE_DIR = os.getenv('PPP_CACHE_DIR', os.path.join(os.getcwd(), 'cache'))
+TASK_CACHE_MAX_ENTRIES = int(os.getenv('TASK_CACHE_MAX_ENTRIES', 100000))
+TASK_CACHE_MAX_BYTES = int(os.getenv('TASK_CACHE_MAX_BYTES', 50 * 1024 * 1024))
+TASK_CACHE_MAX_AGE_DAYS = float(os.getenv('TASK_CACHE_MAX_AGE_DAYS', 30))
+
+# finished reports, returned straight away when the same workbook, sheet and audience are asked for again that day
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv('REPORT_CACHE_MAX_ENTRIES', 1000))
+REPORT_CACHE_MAX_BYTES = int(os.getenv('REPORT_CACHE_MAX_BYTES', 100 * 1024 * 1024))
+REPORT_CACHE_MAX_AGE_DAYS = float(os.getenv('REPORT_CACHE_MAX_AGE_DAYS', 1))
+
+# last run of every board (per sheet and audience), so delta PPPs only ask openai about changed tasks
+SNAPSHOT_MAX_ENTRIES = int(os.getenv('SNAPSHOT_MAX_ENTRIES', 256))
+SNAPSHOT_MAX_BYTES = int(os.getenv('SNAPSHOT_MAX_BYTES', 200 * 1024 * 1024))
+SNAPSHOT_MAX_AGE_DAYS = float(os.getenv('SNAPSHOT_MAX_AGE_DAYS', 90))
+
+# background PPP generation (/generatePPP?async=1)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))  # reports generated at the same time per process
+JOB_RESULT_TTL = float(os.getenv('JOB_RESULT_TTL', 60 * 60))  # seconds a finished report can be fetched
+
+# parsed sheets, reused when the same workbook is uploaded again (for another sheet or audience)
+SHEET_CACHE_MAX_ENTRIES = int(os.getenv('SHEET_CACHE_MAX_ENTRIES', 64))
+
+# workbooks at least this large are read row by row (openpyxl read-only mode) and only their reported tasks are
+# kept, instead of parsing (and caching) the whole sheet -- keeps memory flat on very large exports
+STREAMING_MIN_BYTES = int(os.getenv('STREAMING_MIN_BYTES', 2 * 1024 * 1024))
+STREAMING_CHUNK_ROWS = int(os.getenv('STREAMING_CHUNK_ROWS', 5000))  # sheet rows filtered at a time
+
+# task fields, besides the ones the report itself needs, read from a board export and described to openai
+PROMPT_FIELDS = [field.strip() for field in
+                 os.getenv('PROMPT_FIELDS', 'Name,Department,Subitems,DRI,Status,Comments').split(',')]
+PROMPT_FIELD_MAX_TOKENS = int(os.getenv('PROMPT_FIELD_MAX_TOKENS', 150))  # longer free text fields are cut short
+
+# adds how long each stage of a report took below it (see also /metrics)
+TIMING_FOOTER = os.getenv('TIMING_FOOTER', '0') == '1'
@@ -0,0 +1,130 @@
+import argparse
+import ast
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """answers chat completions like the PPP prompts expect, after a configurable delay,
+    and fails a configurable share of them with 429"""
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real api
+
+    def log_message(self, message_format, *args):  # quiet
+        pass
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+        except (BrokenPipeError, ConnectionResetError):  # the client timed out and hung up
+            self.close_connection = True
+
+    def do_GET(self):
+        if self.path.startswith('/v1/models/'):  # /healthz
+            self.send_json(200, {'id': self.path.rsplit('/', 1)[-1], 'object': 'model', 'owned_by': 'fake'})
+        else:
+            self.send_json(404, {'error': {'message': 'not found'}})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if not self.path.endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': 'not found'}})
+            return
+
+        server = self.server
+        if random.random() < server.slow_rate:  # the long tail
+            time.sleep(server.slow_latency)
+        else:
+            time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        with server.lock:
+            server.requests += 1
+            rate_limited = random.random() < server.rate_limit
+            if rate_limited:
+                server.rate_limited += 1
+        if rate_limited:
+            self.send_json(429, {'error': {'message': 'Rate limit reached (fake)', 'type': 'requests'}},
+                           headers={'retry-after': str(server.retry_after)})
+            return
+
+        user_prompt = request['messages'][-1]['content']
+        if request.get('response_format', {}).get('type') == 'json_object':  # a batch of tasks
+            batch = json.loads(user_prompt.split(': ', 1)[1])
+            content = json.dumps({task_id: format_task(task) for task_id, task in batch.items()})
+        else:
+            content = format_task(user_prompt.split(': ', 1)[1])
+        prompt_tokens = sum(len(message['content']) for message in request['messages']) // 4
+        completion_tokens = len(content) // 4
+        self.send_json(200, {
+            'id': f"chatcmpl-fake-{server.requests}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request['model'],
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': content}}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                      'total_tokens': prompt_tokens + completion_tokens}
+        })
+
+
+def format_task(task):
+    """'<b>GOAL</b>: SUMMARY [ASSIGNEE]' from the task's fields, given as a dict, its repr or 'Field: value' lines"""
+    if isinstance(task, str):
+        try:
+            task = ast.literal_eval(task)
+        except (ValueError, SyntaxError):
+            task = dict(re.findall(r'^-?\s*([^:\n]+):\s*(.*)$', task, flags=re.MULTILINE))
+    if not isinstance(task, dict):
+        task = {}
+    return (f"<b>{task.get('Department') or 'Team Initiative'}</b>: {task.get('Name') or 'Task'} "
+            f"<span class='assignee'>[{task.get('DRI') or 'Unassigned'}]</span>")
+
+
+def start(port=0, latency=0.5, jitter=0.2, rate_limit=0.0, retry_after=1, slow_rate=0.0, slow_latency=30):
+    """runs a fake openai server on a background thread -- point OPENAI_BASE_URL at f"{server.url}" """
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency  # seconds per completion
+    server.jitter = jitter  # +/- seconds
+    server.rate_limit = rate_limit  # share of completions answered with 429
+    server.retry_after = retry_after  # seconds sent with every 429
+    server.slow_rate = slow_rate  # share of completions that take slow_latency seconds instead
+    server.slow_latency = slow_latency
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.rate_limited = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='local stand-in for the openai chat completions api')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds per completion')
+    parser.add_argument('--jitter', type=float, default=0.2, help='+/- seconds added to every completion')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='share of completions answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1, help='seconds sent with every 429')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='share of completions that are very slow')
+    parser.add_argument('--slow-latency', type=float, default=30, help='seconds a very slow completion takes')
+    args = parser.parse_args()
+    server = start(args.port, args.latency, args.jitter, args.rate_limit, args.retry_after, args.slow_rate,
+                   args.slow_latency)
+    print(f"Fake openai listening on {server.url} -- export OPENAI_BASE_URL={server.url} OPENAI_API_KEY=fake")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,106 +1,102 @@
+import html
+import time
 import pandas as pd
 from datetime import datetime, timedelta
-import openai
-import requests
-from config import OPENAI_API_KEY
-
+from config import LLM_BATCH_SIZE, REPORT_DEADLINE
+from llm import LLMError, ask_openai, ask_openai_batch, dispatcher, get_client
+from prompts import build_task_prompt, log_prompt_tokens, mark_fallback, prompt_value
+
+
+# static, nothing task specific goes in here -- every request starts with the same bytes,
+# which lets openai reuse its cached prefix
+SYSTEM_PROMPT = (
+    "You are an expert in summarizing and restructuring tasks.\n"
+    "Your purpose is to analyze the provided details for a task, and "
+    "extract critical information that is important and relevant for an executive summary.\n"
+    "NOTE: keep GOAL and NAME simple, concise, and easy to understand."
+    "1. Identify the executive business goal/objective/ corporate initiative this task addresses. "
+    "This field is called GOAL.\n"
+    "2. Name this task. This should briefly describe in summary what the task is specifically. "
+    "This field is called NAME.\n"
+    "3. Identify which individual(s) is in charge of driving/ completing this task. "
+    "This field is called ASSIGNEE.\n"
+    "4. FORMAT YOUR RESPONSE: format the fields identified in steps 1-3 in your response. Use this syntax:\n"
+    "<b>{GOAL}</b>: {NAME} [{ASSIGNEE}]\n"
+    "NOTE: fields are enclosed in curly brackets {}. "
+    "Replace the fields enclosed in curly brackets with the information you've identified.\n"
+    "\n"
+    "Here is an example of how a task should be formatted in your response: \n"
+    "<b>Internship Training Program: Give all interns access to Mission Control trainings [Program Lead]\n"
+)
+
+
+# the only columns of a legacy sheet this module knows of -- the rest differ from sheet to sheet
+DECORATED_COLUMNS = ['Target Date', 'Complete Date', 'Status', 'Comments', 'Original Target Date']
+
+
+def task_prompt(row):
+    """task information sent to openai for a row -- every column it has a value for, as a legacy sheet's
+    columns aren't known (mondayPPP's PROMPT_FIELDS are Monday board columns), see prompts.build_task_prompt"""
+    return build_task_prompt(row, fields=row.index)
+
+
+def fallback_task(row):
+    """a task formatted locally, for when openai didn't format it in time: the row's values, in column order,
+    leaving out the columns decorate_task shows or the sections are picked by"""
+    values = [prompt_value(row[column]) for column in row.index if column not in DECORATED_COLUMNS]
+    return mark_fallback(html.escape(' | '.join(value for value in values if value is not None) or '(no details)'))
+
+
+def decorate_task(row, task, has_og_target_date, has_comments, is_blocked=False, is_overdue=False):
+    """wraps a formatted task with its target date and blocked/ overdue markers
+    (a task openai didn't format, task None, is formatted locally)"""
+    if task is None:
+        task = fallback_task(row)
+    if pd.notna(row['Target Date']):
+        target_date = f"<span class='date'>{row['Target Date'].strftime('%-m/%-d')}</span> "
+    else:  # no target date (e.g. a blocked task without a timeline)
+        target_date = ""
+    if has_og_target_date and pd.notna(row['Original Target Date']):  # task has an original target date to include
+        og_target_date = f"<span class='og-date'>({row['Original Target Date'].strftime('%-m/%-d')})</span> "
+    else:
+        og_target_date = ""
+    if is_blocked:  # task is blocked
+        if has_comments and pd.notna(row['Comments']):
+            blocked = f"<span class='red-text'>({row['Comments']})</span> "
+        else:
+            blocked = "<span class='red-text'>(blocked)</span> "
+    else:
+        blocked = ""
+    if is_overdue:  # task is overdue
+        overdue = "<span class='red-text'>(overdue)</span>"
+    else:
+        overdue = ""
 
-# debugging connection errors
-print(f"OpenAI library version: {openai.__version__}")
-print(f"API Key (first 5 chars): {OPENAI_API_KEY[:5]}...")
-try:
-    response = requests.get("https://api.openai.com/v1/engines",
-                            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"})
-    print(f"OpenAI API response status: {response.status_code}")
-    print(f"OpenAI API response: {response.text[:100]}...")  # Print first 100 chars
-except requests.RequestException as request_error:
-    print(f"Error reaching OpenAI API: {request_error}")
+    return f"{target_date}{og_target_date}{task} {blocked}{overdue}", row['Target Date']
 
 
-# configuring openAI access
-openai.api_key = OPENAI_API_KEY
-client = openai.OpenAI()  # creating an OpenAI client instance
+def by_target_date(task):
+    """sort key for formatted tasks, tasks without a target date go last"""
+    return task[1] if pd.notna(task[1]) else pd.Timestamp.max
 
 
-def ask_openai(openai_client, system_prompt, user_prompt):
-    """calls openai"""
-    try:
-        completion = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            temperature=0,
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": f"Here is the task information: {user_prompt}"
-                }
-            ]
-        )
-        return completion.choices[0].message.content
-    # debugging
-    except Exception as openai_error:
-        return f"Unexpected error: {openai_error}"
-
-
-def format_task(row, has_og_target_date, has_comments, is_blocked=False, is_overdue=False):
+def format_task(row, has_og_target_date, has_comments, is_blocked=False, is_overdue=False, deadline=None):
     """formats the progress, plan, and overdue tasks using AI"""
     try:
-        target_date = row['Target Date'].strftime('%-m/%-d')
-        if has_og_target_date and pd.notna(row['Original Target Date']):  # task has an original target date to include
-            og_target_date = f"<span class='og-date'>({row['Original Target Date'].strftime('%-m/%-d')})</span> "
-        else:
-            og_target_date = ""
-        if is_blocked:  # task is blocked
-            if has_comments and pd.notna(row['Comments']):
-                blocked = f"<span class='red-text'>({row['Comments']})</span> "
-            else:
-                blocked = "<span class='red-text'>(blocked)</span> "
-        else:
-            blocked = ""
-        if is_overdue:  # task is overdue
-            overdue = "<span class='red-text'>(overdue)</span>"
-        else:
-            overdue = ""
-
-        # setting AI prompts up
-        user_prompt = row.to_dict()
-        system_prompt = (
-            "You are an expert in summarizing and restructuring tasks.\n"
-            "Your purpose is to analyze the provided details for a task, and "
-            "extract critical information that is important and relevant for an executive summary.\n"
-            "NOTE: keep GOAL and NAME simple, concise, and easy to understand."
-            "1. Identify the executive business goal/objective/ corporate initiative this task addresses. "
-            "This field is called GOAL.\n"
-            "2. Name this task. This should briefly describe in summary what the task is specifically. "
-            "This field is called NAME.\n"
-            "3. Identify which individual(s) is in charge of driving/ completing this task. "
-            "This field is called ASSIGNEE.\n"
-            "4. FORMAT YOUR RESPONSE: format the fields identified in steps 1-3 in your response. Use this syntax:\n"
-            "<b>{GOAL}</b>: {NAME} [{ASSIGNEE}]\n"
-            "NOTE: fields are enclosed in curly brackets {}. "
-            "Replace the fields enclosed in curly brackets with the information you've identified.\n"
-            "\n"
-            "Here is an example of how a task should be formatted in your response: \n"
-            "<b>Internship Training Program: Give all interns access to Mission Control trainings [Program Lead]\n"
-        )
-
-        # asking AI
-        task = ask_openai(client, system_prompt, user_prompt)
-        print(task)
-
-        return f"<span class='date'>{target_date}</span> {og_target_date}{task} {blocked}{overdue}", row['Target Date']
-
-    except Exception as formatting_error:
-        return f"Error formatting task: {formatting_error}"
-
-
-def create_ppp(file_path, pg=None):
+        task = ask_openai(get_client(), SYSTEM_PROMPT, task_prompt(row), deadline=deadline)
+    except LLMError as task_error:
+        print(f"Error: {task_error} -- formatting the task locally")
+        task = None
+    print(task)
+    return decorate_task(row, task, has_og_target_date, has_comments, is_blocked=is_blocked, is_overdue=is_overdue)
+
+
+def create_ppp(file_path, pg=None, batch_size=LLM_BATCH_SIZE):
     """takes a file path and a page to an Excel sheet (provided optionally)
-    and generates a PPP for it"""
+    and generates a PPP for it -- batch_size tasks share one openai call (1 asks per task).
+    tasks openai hasn't formatted by REPORT_DEADLINE are formatted locally"""
     try:
+        deadline = time.monotonic() + REPORT_DEADLINE if REPORT_DEADLINE else None
         if pg:  # page to Excel sheet provided
             df = pd.read_excel(file_path, sheet_name=pg)
         else:  # no page to Excel sheet provided
@@ -130,27 +126,29 @@ def create_ppp(file_path, pg=None):
         blocked_section = df[df['Status'] == 'Blocked']
         overdue_section = df[(df['Target Date'] <= today) * (df['Status'] != 'Completed')]
 
-        # formatting tasks for PPP
-        progress_tasks = [
-            format_task(row, has_og_target_date, has_comments)
-            for index, row in progress_section.iterrows()
-        ]
-        plan_tasks = [
-            format_task(row, has_og_target_date, has_comments)
-            for index, row in plan_section.iterrows()
-        ]
-        problem_tasks = [
-            format_task(row, has_og_target_date, has_comments, is_blocked=True)
-            for index, row in blocked_section.iterrows()
-        ] + [
-            format_task(row, has_og_target_date, has_comments, is_overdue=True)
-            for index, row in overdue_section.iterrows()
-        ]
+        # formatting tasks for PPP -- either batch_size tasks per openai call or one call per task
+        jobs = ([('progress', row, {}) for index, row in progress_section.iterrows()] +
+                [('plan', row, {}) for index, row in plan_section.iterrows()] +
+                [('problems', row, {'is_blocked': True}) for index, row in blocked_section.iterrows()] +
+                [('problems', row, {'is_overdue': True}) for index, row in overdue_section.iterrows()])
+        prompts = {str(i): task_prompt(job[1]) for i, job in enumerate(jobs)}
+        log_prompt_tokens([job[1] for job in jobs], prompts.values())
+        if batch_size > 1:
+            tasks, _ = ask_openai_batch(get_client(), SYSTEM_PROMPT, prompts, batch_size=batch_size,
+                                        deadline=deadline)
+            formatted = [decorate_task(job[1], tasks[str(i)], has_og_target_date, has_comments, **job[2])
+                         for i, job in enumerate(jobs)]
+        else:
+            formatted = dispatcher.map(
+                lambda job: format_task(job[1], has_og_target_date, has_comments, deadline=deadline, **job[2]), jobs)
+        progress_tasks = [task for job, task in zip(jobs, formatted) if job[0] == 'progress']
+        plan_tasks = [task for job, task in zip(jobs, formatted) if job[0] == 'plan']
+        problem_tasks = [task for job, task in zip(jobs, formatted) if job[0] == 'problems']
 
         # sorting tasks for each section by target date
-        progress = sorted(progress_tasks, key=lambda target_date: target_date[1])
-        plan = sorted(plan_tasks, key=lambda target_date: target_date[1])
-        problems = sorted(problem_tasks, key=lambda target_date: target_date[1])
+        progress = sorted(progress_tasks, key=by_target_date)
+        plan = sorted(plan_tasks, key=by_target_date)
+        problems = sorted(problem_tasks, key=by_target_date)
 
         # formatting PPP
         progress_output = "<br>".join(f"  •  {task[0]}" for task in progress) + "<br><br>"
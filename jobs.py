@@ -0,0 +1,66 @@
+import hashlib
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+def job_key(workbook, sheet_name, audience, board=None):
+    """identifies a submission: the workbook's contents plus the sheet and audience asked for
+    (and the board, for a delta report)"""
+    return f"{hashlib.sha256(workbook).hexdigest()}:{sheet_name or ''}:{audience}:{board or ''}"
+
+
+class JobQueue:
+    """runs PPP generations on a bounded pool of background threads so requests return right away.
+    identical submissions that are still queued or running share one job, and finished jobs are
+    kept for result_ttl seconds. jobs live in this process only"""
+
+    def __init__(self, workers, result_ttl):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ppp-job')
+        self.result_ttl = result_ttl
+        self.jobs = {}  # job id -> job
+        self.active = {}  # job key -> id of the queued/running job for it
+        self.lock = threading.Lock()
+
+    def submit(self, key, fn, *args, **kwargs):
+        """queues fn(*args, **kwargs) unless an identical job is in flight -- returns (job, deduplicated)"""
+        with self.lock:
+            self.expire()
+            if key in self.active:
+                return dict(self.jobs[self.active[key]]), True
+            job = {'id': uuid.uuid4().hex, 'status': 'queued', 'created': time.time(),
+                   'started': None, 'finished': None, 'result': None, 'error': None}
+            self.jobs[job['id']] = job
+            self.active[key] = job['id']
+        self.executor.submit(self.run, key, job, fn, args, kwargs)
+        return dict(job), False
+
+    def run(self, key, job, fn, args, kwargs):
+        with self.lock:
+            job.update(status='running', started=time.time())
+        try:
+            result = fn(*args, **kwargs)
+            with self.lock:
+                job.update(status='done', result=result)
+        except Exception as job_error:
+            print(f"Error: {job_error}")
+            with self.lock:
+                job.update(status='failed', error=str(job_error))
+        finally:
+            with self.lock:
+                job['finished'] = time.time()
+                del self.active[key]
+
+    def get(self, job_id):
+        """a snapshot of the job, or None if it never existed or its result expired"""
+        with self.lock:
+            self.expire()
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def expire(self):
+        """drops finished jobs older than result_ttl (call with the lock held)"""
+        cutoff = time.time() - self.result_ttl
+        for job_id in [job_id for job_id, job in self.jobs.items() if job['finished'] and job['finished'] < cutoff]:
+            del self.jobs[job_id]
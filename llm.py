@@ -0,0 +1,675 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+import os
+import httpx
+import openai
+import metrics
+from cache import DiskCache, content_key
+from config import (OPENAI_API_KEY, OPENAI_MODEL, OPENAI_BASE_URL, HEALTH_CHECK_TTL, LLM_MAX_IN_FLIGHT,
+                    LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_MAX_RETRIES, LLM_BACKOFF_BASE, LLM_BACKOFF_MAX,
+                    LLM_BATCH_SIZE, LLM_BATCH_ROUNDS, LLM_CALL_TIMEOUT, LLM_HEDGE_AFTER, CACHE_DIR,
+                    TASK_CACHE_MAX_ENTRIES, TASK_CACHE_MAX_BYTES, TASK_CACHE_MAX_AGE_DAYS)
+
+
+TEMPERATURE = 0  # deterministic answers are what makes caching them safe
+COMPLETION_TOKENS_ESTIMATE = 60  # a formatted task is one short line
+
+# appended to the system prompt when several tasks share one completion
+BATCH_INSTRUCTIONS = (
+    "\n"
+    "You will be given several tasks at once as a JSON object that maps a task id to that task's information.\n"
+    "Format every task exactly as described above. Respond ONLY with a JSON object that maps "
+    "each task id to that task's formatted line, for example:\n"
+    "{\"0\": \"<b>{GOAL}</b>: {SUMMARY} <span class='assignee'>[{ASSIGNEE}]</span>\"}\n"
+)
+
+
+class LLMError(Exception):
+    """raised when openai could not produce a completion after retrying"""
+
+
+def estimate_tokens(text):
+    """rough token count for pacing (~4 characters per token)"""
+    return len(str(text)) // 4 + 1
+
+
+class TokenBucket:
+    """refills per_minute units every minute; acquire blocks until enough units are available"""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60  # units per second
+        self.available = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        """takes amount units if they are available -- returns 0, otherwise the seconds until they will be"""
+        amount = min(amount, self.capacity)  # never wait for more than the bucket can hold
+        with self.lock:
+            now = time.monotonic()
+            self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.available >= amount:
+                self.available -= amount
+                return 0
+            return (amount - self.available) / self.rate
+
+    def refund(self, amount=1):
+        """gives back units taken by reserve but not used"""
+        with self.lock:
+            self.available = min(self.capacity, self.available + min(amount, self.capacity))
+
+    def check_deadline(self, delay, deadline):
+        if deadline is not None and time.monotonic() + delay > deadline:
+            raise LLMError("Report deadline reached waiting for the openai rate limit")
+
+    def acquire(self, amount=1, deadline=None):
+        """raises LLMError instead of waiting past deadline (a time.monotonic() value)"""
+        while True:
+            delay = self.reserve(amount)
+            if not delay:
+                return
+            self.check_deadline(delay, deadline)
+            time.sleep(delay)
+
+    async def acquire_async(self, amount=1, deadline=None):
+        """acquire for coroutines, waiting without holding a thread"""
+        while True:
+            delay = self.reserve(amount)
+            if not delay:
+                return
+            self.check_deadline(delay, deadline)
+            await asyncio.sleep(delay)
+
+
+def is_retryable(openai_error):
+    """429s, 5xx responses, timeouts and dropped connections are worth retrying"""
+    if isinstance(openai_error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(openai_error, openai.APIStatusError) and openai_error.status_code >= 500
+
+
+def backoff_delay(attempt, openai_error=None):
+    """exponential backoff with full jitter, honouring a retry-after header when openai sends one"""
+    response = getattr(openai_error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(LLM_BACKOFF_MAX, float(retry_after))
+    except ValueError:  # http-date form, fall back to our own schedule
+        pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+class Dispatcher:
+    """bounds, paces and retries chat completions -- one instance is shared by the whole process
+    so concurrent reports draw from the same request/token budget. a completion still running after
+    hedge_after seconds is sent a second time and whichever answers first wins"""
+
+    def __init__(self, max_in_flight=LLM_MAX_IN_FLIGHT, requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+                 tokens_per_minute=LLM_TOKENS_PER_MINUTE, max_retries=LLM_MAX_RETRIES,
+                 call_timeout=LLM_CALL_TIMEOUT, hedge_after=LLM_HEDGE_AFTER):
+        self.max_in_flight = max_in_flight
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.call_timeout = call_timeout
+        self.hedge_after = hedge_after
+        self.hedges = ThreadPoolExecutor(max_workers=max_in_flight * 2, thread_name_prefix='llm-hedge')
+
+    def complete(self, openai_client, messages, completion_tokens=COMPLETION_TOKENS_ESTIMATE, deadline=None,
+                 **options):
+        """sends one chat completion and returns its text, raising LLMError once retries run out
+        or when deadline (a time.monotonic() value) would pass first"""
+        expected_tokens = prompt_tokens(messages) + completion_tokens
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.hedged_call(openai_client, messages, expected_tokens, deadline, options)
+            except LLMError:
+                raise
+            except Exception as openai_error:
+                if not is_retryable(openai_error) or attempt == self.max_retries:
+                    raise LLMError(f"OpenAI request failed after {attempt + 1} attempt(s): {openai_error}") \
+                        from openai_error
+                delay = backoff_delay(attempt, openai_error)
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    raise LLMError(f"Report deadline reached retrying openai: {openai_error}") from openai_error
+                metrics.llm_retries.inc(reason=type(openai_error).__name__)
+                time.sleep(delay)
+
+    def hedged_call(self, openai_client, messages, expected_tokens, deadline, options):
+        """one completion attempt, sent again if it hasn't answered hedge_after seconds after it was sent --
+        the first answer wins (the slower call is left to finish on its own, openai calls can't be cancelled).
+        the clock starts once the call has its budget and connection slot, so a call waiting on the rate limit
+        isn't hedged, and a hedge is only sent if budget and a slot are free right away"""
+        timeout = self.acquire(expected_tokens, deadline)
+        if not self.hedge_after:
+            return self.send(openai_client, messages, timeout, options)
+        primary = self.hedges.submit(self.send, openai_client, messages, timeout, options)
+        if wait([primary], timeout=self.hedge_after).done:
+            return primary.result()
+        hedge_timeout = self.try_acquire(expected_tokens, deadline)
+        if hedge_timeout is None:  # the budget is short, don't spend more of it
+            return primary.result()
+        metrics.llm_hedges.inc()
+        hedge = self.hedges.submit(self.send, openai_client, messages, hedge_timeout, options)
+        call_errors = []
+        for future in as_completed([primary, hedge]):
+            try:
+                return future.result()
+            except Exception as call_error:
+                call_errors.append(call_error)
+        raise call_errors[0]
+
+    def call_timeout_before(self, deadline):
+        """seconds a call may take, call_timeout cut short by deadline"""
+        if deadline is None:
+            return self.call_timeout
+        return min(self.call_timeout, deadline - time.monotonic())
+
+    def acquire(self, expected_tokens, deadline):
+        """waits for the request and token budget and a connection slot, raising LLMError rather than waiting
+        past deadline -- returns the call's timeout. the slot is released by send, budget taken for a call
+        that gives up waiting goes back to the buckets"""
+        self.requests.acquire(deadline=deadline)
+        try:
+            self.tokens.acquire(expected_tokens, deadline=deadline)
+        except BaseException:
+            self.requests.refund()
+            raise
+        if deadline is None:
+            self.in_flight.acquire()
+            return self.call_timeout
+        timeout = self.call_timeout_before(deadline)
+        if timeout <= 0 or not self.in_flight.acquire(timeout=timeout):
+            self.refund(expected_tokens)
+            raise LLMError("Report deadline reached waiting for an openai connection")
+        return self.call_timeout_before(deadline)
+
+    def refund(self, expected_tokens):
+        """gives the request and token budget of a call that won't be sent back to the buckets"""
+        self.requests.refund()
+        self.tokens.refund(expected_tokens)
+
+    def try_acquire(self, expected_tokens, deadline):
+        """acquire without waiting -- the call's timeout, or None when budget or a slot isn't free right now"""
+        timeout = self.call_timeout_before(deadline)
+        if timeout <= 0 or not self.in_flight.acquire(blocking=False):
+            return None
+        if self.requests.reserve():
+            self.in_flight.release()
+            return None
+        if self.tokens.reserve(expected_tokens):
+            self.requests.refund()
+            self.in_flight.release()
+            return None
+        return timeout
+
+    def send(self, openai_client, messages, timeout, options):
+        """sends an acquired completion, abandoned after timeout seconds, and releases its slot"""
+        try:
+            start = time.perf_counter()
+            try:
+                completion = openai_client.chat.completions.create(
+                    model=OPENAI_MODEL,
+                    temperature=TEMPERATURE,
+                    messages=messages,
+                    timeout=max(timeout, 0.001),
+                    **options
+                )
+            except Exception:
+                metrics.llm_request_seconds.observe(time.perf_counter() - start, outcome='error')
+                raise
+            metrics.llm_request_seconds.observe(time.perf_counter() - start, outcome='ok')
+        finally:
+            self.in_flight.release()
+        return completion_text(completion)
+
+    def map(self, fn, items):
+        """applies fn to every item concurrently; results keep the order of items"""
+        items = list(items)
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(items))) as executor:
+            return list(executor.map(fn, items))
+
+    def map_as_completed(self, fn, items):
+        """applies fn to every item concurrently, yielding (index, result) as soon as each one finishes"""
+        items = list(items)
+        if not items:
+            return
+        executor = ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(items)))
+        try:
+            futures = {executor.submit(fn, item): index for index, item in enumerate(items)}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:  # a closed generator (e.g. client went away) drops the tasks that haven't started
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AsyncDispatcher:
+    """Dispatcher for coroutines (the async server, see asgi.py): the same bounds, pacing, retries, timeouts
+    and hedging, but a completion waiting on openai holds no thread. it paces against the token buckets of
+    the dispatcher it is given, so both paths draw from one request/token budget per process"""
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        self.in_flight = None  # created on first use, on the server's event loop
+
+    def semaphore(self):
+        if self.in_flight is None:
+            self.in_flight = asyncio.Semaphore(self.dispatcher.max_in_flight)
+        return self.in_flight
+
+    async def complete(self, openai_client, messages, completion_tokens=COMPLETION_TOKENS_ESTIMATE, deadline=None,
+                       **options):
+        """Dispatcher.complete, awaited"""
+        expected_tokens = prompt_tokens(messages) + completion_tokens
+        for attempt in range(self.dispatcher.max_retries + 1):
+            try:
+                return await self.hedged_call(openai_client, messages, expected_tokens, deadline, options)
+            except LLMError:
+                raise
+            except Exception as openai_error:
+                if not is_retryable(openai_error) or attempt == self.dispatcher.max_retries:
+                    raise LLMError(f"OpenAI request failed after {attempt + 1} attempt(s): {openai_error}") \
+                        from openai_error
+                delay = backoff_delay(attempt, openai_error)
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    raise LLMError(f"Report deadline reached retrying openai: {openai_error}") from openai_error
+                metrics.llm_retries.inc(reason=type(openai_error).__name__)
+                await asyncio.sleep(delay)
+
+    async def hedged_call(self, openai_client, messages, expected_tokens, deadline, options):
+        """Dispatcher.hedged_call, awaited -- unlike with threads, the slower call is cancelled"""
+        timeout = await self.acquire(expected_tokens, deadline)
+        if not self.dispatcher.hedge_after:
+            return await self.send(openai_client, messages, timeout, options)
+        calls = [asyncio.ensure_future(self.send(openai_client, messages, timeout, options))]
+        try:
+            done, _ = await asyncio.wait(calls, timeout=self.dispatcher.hedge_after)
+            if not done:
+                hedge_timeout = await self.try_acquire(expected_tokens, deadline)
+                if hedge_timeout is None:  # the budget is short, don't spend more of it
+                    return await calls[0]
+                metrics.llm_hedges.inc()
+                calls.append(asyncio.ensure_future(self.send(openai_client, messages, hedge_timeout, options)))
+            call_errors = []
+            for next_call in asyncio.as_completed(calls):
+                try:
+                    return await next_call
+                except Exception as call_error:
+                    call_errors.append(call_error)
+            raise call_errors[0]
+        finally:
+            for pending_call in calls:
+                pending_call.cancel()
+
+    async def acquire(self, expected_tokens, deadline):
+        """Dispatcher.acquire, awaited"""
+        await self.dispatcher.requests.acquire_async(deadline=deadline)
+        try:
+            await self.dispatcher.tokens.acquire_async(expected_tokens, deadline=deadline)
+        except BaseException:  # the deadline, or a hedge that lost (cancelled)
+            self.dispatcher.requests.refund()
+            raise
+        in_flight = self.semaphore()
+        try:
+            if deadline is None:
+                await in_flight.acquire()
+                return self.dispatcher.call_timeout
+            await asyncio.wait_for(in_flight.acquire(), max(self.dispatcher.call_timeout_before(deadline), 0))
+        except asyncio.TimeoutError:
+            self.dispatcher.refund(expected_tokens)
+            raise LLMError("Report deadline reached waiting for an openai connection") from None
+        except BaseException:
+            self.dispatcher.refund(expected_tokens)
+            raise
+        return self.dispatcher.call_timeout_before(deadline)
+
+    async def try_acquire(self, expected_tokens, deadline):
+        """Dispatcher.try_acquire, awaited (a semaphore that isn't locked is acquired without waiting)"""
+        in_flight = self.semaphore()
+        timeout = self.dispatcher.call_timeout_before(deadline)
+        if timeout <= 0 or in_flight.locked():
+            return None
+        await in_flight.acquire()
+        if self.dispatcher.requests.reserve():
+            in_flight.release()
+            return None
+        if self.dispatcher.tokens.reserve(expected_tokens):
+            self.dispatcher.requests.refund()
+            in_flight.release()
+            return None
+        return timeout
+
+    async def send(self, openai_client, messages, timeout, options):
+        """Dispatcher.send, awaited"""
+        in_flight = self.semaphore()
+        try:
+            start = time.perf_counter()
+            try:
+                completion = await openai_client.chat.completions.create(
+                    model=OPENAI_MODEL,
+                    temperature=TEMPERATURE,
+                    messages=messages,
+                    timeout=max(timeout, 0.001),
+                    **options
+                )
+            except Exception:
+                metrics.llm_request_seconds.observe(time.perf_counter() - start, outcome='error')
+                raise
+            metrics.llm_request_seconds.observe(time.perf_counter() - start, outcome='ok')
+        finally:
+            in_flight.release()
+        return completion_text(completion)
+
+
+def completion_text(completion):
+    """a completion's answer, counting the tokens openai reports it used"""
+    if completion.usage is not None:
+        metrics.llm_tokens.inc(completion.usage.prompt_tokens, kind='prompt')
+        metrics.llm_tokens.inc(completion.usage.completion_tokens, kind='completion')
+    return completion.choices[0].message.content
+
+
+dispatcher = Dispatcher()  # shared by every report generated in this process
+async_dispatcher = AsyncDispatcher(dispatcher)  # the same budget, for the async server
+
+# formatted tasks keyed by task_key, shared by every worker on this machine
+task_cache = DiskCache(os.path.join(CACHE_DIR, 'tasks.sqlite3'), max_entries=TASK_CACHE_MAX_ENTRIES,
+                       max_bytes=TASK_CACHE_MAX_BYTES, max_age=TASK_CACHE_MAX_AGE_DAYS * 24 * 60 * 60)
+
+
+client = None  # created on first use, see get_client
+async_client = None  # created on first use, see get_async_client
+client_lock = threading.Lock()
+health = {}  # last check_connectivity result
+
+
+def get_client():
+    """the process-wide openai client, created on first use with a pooled keep-alive connection"""
+    global client
+    with client_lock:
+        if client is None:
+            client = openai.OpenAI(
+                api_key=OPENAI_API_KEY,
+                base_url=OPENAI_BASE_URL,
+                max_retries=0,  # the dispatcher does the retrying
+                http_client=httpx.Client(limits=httpx.Limits(max_connections=LLM_MAX_IN_FLIGHT * 2,
+                                                             max_keepalive_connections=LLM_MAX_IN_FLIGHT))
+            )
+        return client
+
+
+def get_async_client():
+    """the process-wide async openai client (for the async server), created on first use -- on the server's
+    event loop, which its connection pool is bound to"""
+    global async_client
+    with client_lock:
+        if async_client is None:
+            async_client = openai.AsyncOpenAI(
+                api_key=OPENAI_API_KEY,
+                base_url=OPENAI_BASE_URL,
+                max_retries=0,  # the dispatcher does the retrying
+                http_client=httpx.AsyncClient(limits=httpx.Limits(max_connections=LLM_MAX_IN_FLIGHT * 2,
+                                                                  max_keepalive_connections=LLM_MAX_IN_FLIGHT))
+            )
+        return async_client
+
+
+def check_connectivity():
+    """whether openai is reachable with our key -- the result is reused for HEALTH_CHECK_TTL seconds"""
+    with client_lock:
+        if health and time.monotonic() - health['checked'] < HEALTH_CHECK_TTL:
+            return health['result']
+    try:
+        get_client().with_options(timeout=5).models.retrieve(OPENAI_MODEL)
+        result = {'ok': True, 'model': OPENAI_MODEL}
+    except Exception as openai_error:
+        result = {'ok': False, 'model': OPENAI_MODEL, 'error': f"{type(openai_error).__name__}: {openai_error}"}
+    with client_lock:
+        health.update(checked=time.monotonic(), result=result)
+    return result
+
+
+def task_key(system_prompt, user_prompt):
+    """cache key for one task: its normalized fields, the prompt, the model and the temperature"""
+    return content_key(user_prompt, system_prompt, OPENAI_MODEL, TEMPERATURE)
+
+
+def task_messages(system_prompt, user_prompt):
+    """chat messages asking for a single task"""
+    return [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {
+            "role": "user",
+            "content": f"Here is the task information: {user_prompt}"
+        }
+    ]
+
+
+def batch_messages(system_prompt, batch):
+    """chat messages asking for every task in a {task id: user prompt} batch"""
+    return [
+        {
+            "role": "system",
+            "content": system_prompt + BATCH_INSTRUCTIONS
+        },
+        {
+            "role": "user",
+            "content": f"Here is the task information for each task id: {json.dumps(batch, default=str)}"
+        }
+    ]
+
+
+def prompt_tokens(messages):
+    """estimated prompt tokens for a list of chat messages"""
+    return sum(estimate_tokens(message['content']) for message in messages)
+
+
+def task_answer(text):
+    """a single task's formatted answer -- an empty one (content None, e.g. after a content filter) is an
+    LLMError, so it isn't cached and the task is formatted locally"""
+    if not text or not text.strip():
+        raise LLMError("OpenAI returned an empty answer")
+    return text
+
+
+def ask_openai(openai_client, system_prompt, user_prompt, deadline=None):
+    """calls openai, unless the same task was already formatted with the same prompt"""
+    return task_cache.get_or_compute(
+        task_key(system_prompt, user_prompt),
+        lambda: task_answer(dispatcher.complete(openai_client, task_messages(system_prompt, user_prompt),
+                                                deadline=deadline)))
+
+
+async def ask_openai_async(openai_client, system_prompt, user_prompt, deadline=None):
+    """ask_openai on the async client"""
+    async def compute():
+        return task_answer(await async_dispatcher.complete(openai_client, task_messages(system_prompt, user_prompt),
+                                                           deadline=deadline))
+
+    return await task_cache.get_or_compute_async(task_key(system_prompt, user_prompt), compute)
+
+
+def batch_answers(text, batch):
+    """the {task id: formatted task} a batch response answered, of the ids in batch"""
+    try:
+        answers = json.loads(text or '')  # content is None e.g. after a content filter
+    except ValueError:  # malformed response, every task in the batch counts as missing
+        return {}
+    if not isinstance(answers, dict):
+        return {}
+    return {task_id: answer for task_id, answer in answers.items()
+            if task_id in batch and isinstance(answer, str) and answer.strip()}
+
+
+def ask_openai_batch_once(openai_client, system_prompt, batch, deadline=None):
+    """one completion for a {task id: user prompt} batch -- returns only the ids the response answered
+    (none if openai couldn't be reached)"""
+    try:
+        text = dispatcher.complete(openai_client, batch_messages(system_prompt, batch),
+                                   completion_tokens=COMPLETION_TOKENS_ESTIMATE * len(batch), deadline=deadline,
+                                   response_format={"type": "json_object"})
+    except LLMError as batch_error:  # every task in the batch counts as missing
+        print(f"Error: {batch_error}")
+        return {}
+    return batch_answers(text, batch)
+
+
+async def ask_openai_batch_once_async(openai_client, system_prompt, batch, deadline=None):
+    """ask_openai_batch_once on the async client"""
+    try:
+        text = await async_dispatcher.complete(openai_client, batch_messages(system_prompt, batch),
+                                               completion_tokens=COMPLETION_TOKENS_ESTIMATE * len(batch),
+                                               deadline=deadline, response_format={"type": "json_object"})
+    except LLMError as batch_error:  # every task in the batch counts as missing
+        print(f"Error: {batch_error}")
+        return {}
+    return batch_answers(text, batch)
+
+
+class BatchPlan:
+    """the bookkeeping of one ask_openai_batch: which tasks came from the cache, which are still pending,
+    and the calls and prompt tokens spent compared with asking for every uncached task separately"""
+
+    def __init__(self, system_prompt, user_prompts, batch_size, deadline):
+        self.system_prompt = system_prompt
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self.results = {}
+        self.keys = {}
+        self.pending = {}  # one task id per distinct uncached task
+        pending_keys = set()
+        for task_id, user_prompt in user_prompts.items():
+            task_id = str(task_id)
+            self.keys[task_id] = task_key(system_prompt, user_prompt)
+            cached = task_cache.get(self.keys[task_id])
+            if cached is not None:
+                self.results[task_id] = cached
+            elif self.keys[task_id] not in pending_keys:
+                self.pending[task_id] = user_prompt
+                pending_keys.add(self.keys[task_id])
+        self.stats = {
+            'tasks': len(self.keys),
+            'cached': len(self.results),
+            'calls': 0,
+            'prompt_tokens': 0,
+            'per_task_calls': len(self.pending),
+            'per_task_prompt_tokens': sum(prompt_tokens(task_messages(system_prompt, user_prompt))
+                                          for user_prompt in self.pending.values())
+        }
+        self.asked = dict(self.pending)
+
+    def past_deadline(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def batches(self):
+        """the pending tasks in batches of batch_size"""
+        task_ids = list(self.pending)
+        return [{task_id: self.pending[task_id] for task_id in task_ids[start:start + self.batch_size]}
+                for start in range(0, len(task_ids), self.batch_size)]
+
+    def record_round(self, batches, answered_batches):
+        """caches a round's answers and leaves only the tasks it didn't answer pending"""
+        for answers in answered_batches:
+            for task_id, answer in answers.items():
+                task_cache.set(self.keys[task_id], answer)
+                self.results[task_id] = answer
+        self.stats['calls'] += len(batches)
+        self.stats['prompt_tokens'] += sum(prompt_tokens(batch_messages(self.system_prompt, batch))
+                                           for batch in batches)
+        self.pending = {task_id: user_prompt for task_id, user_prompt in self.pending.items()
+                        if task_id not in self.results}
+        if self.pending:
+            print(f"Batch responses were missing {len(self.pending)} task(s), retrying only those")
+
+    def leftover(self):
+        """the tasks to ask for on their own once the batch rounds are over"""
+        return [] if self.past_deadline() else list(self.pending)
+
+    def record_leftover(self, leftover, tasks):
+        for task_id, task in zip(leftover, tasks):
+            self.results[task_id] = task
+        self.stats['calls'] += len(leftover)
+        self.stats['prompt_tokens'] += sum(prompt_tokens(task_messages(self.system_prompt, self.pending[task_id]))
+                                           for task_id in leftover)
+
+    def finish(self):
+        """({task id: formatted task}, stats) -- tasks identical to one that was sent share its answer"""
+        answered = {self.keys[task_id]: self.results.get(task_id) for task_id in self.asked}
+        for task_id, key in self.keys.items():
+            self.results.setdefault(task_id, answered.get(key))
+
+        stats = self.stats
+        stats['calls_saved'] = stats['per_task_calls'] - stats['calls']
+        stats['prompt_tokens_saved'] = stats['per_task_prompt_tokens'] - stats['prompt_tokens']
+        print(f"Batch mode: {stats['tasks']} task(s), {stats['cached']} from cache, {stats['calls']} call(s), "
+              f"saved {stats['calls_saved']} call(s) and ~{stats['prompt_tokens_saved']} prompt tokens")
+        return self.results, stats
+
+
+def ask_openai_batch(openai_client, system_prompt, user_prompts, batch_size=LLM_BATCH_SIZE, deadline=None):
+    """formats {task id: user prompt} with batch_size tasks per completion
+
+    cached tasks are answered straight from task_cache and identical tasks are only sent once.
+    tasks missing from a batch response are retried in new batches, and asked one at a time
+    after LLM_BATCH_ROUNDS rounds. returns ({task id: formatted task}, stats), where stats
+    compares the calls and prompt tokens spent against asking for every uncached task separately.
+    tasks openai couldn't format, or not before deadline (a time.monotonic() value), are None"""
+    plan = BatchPlan(system_prompt, user_prompts, batch_size, deadline)
+    for batch_round in range(LLM_BATCH_ROUNDS):
+        if not plan.pending or plan.past_deadline():
+            break
+        batches = plan.batches()
+        plan.record_round(batches, dispatcher.map(
+            lambda batch: ask_openai_batch_once(openai_client, system_prompt, batch, deadline=deadline), batches))
+
+    def ask_leftover(task_id):
+        try:
+            return ask_openai(openai_client, system_prompt, plan.pending[task_id], deadline=deadline)
+        except LLMError as task_error:
+            print(f"Error: {task_error}")
+            return None
+
+    # anything still missing is asked for on its own
+    leftover = plan.leftover()
+    plan.record_leftover(leftover, dispatcher.map(ask_leftover, leftover))
+    return plan.finish()
+
+
+async def ask_openai_batch_async(openai_client, system_prompt, user_prompts, batch_size=LLM_BATCH_SIZE,
+                                 deadline=None):
+    """ask_openai_batch on the async client"""
+    # the plan reads and writes the task cache, so that happens on worker threads rather than the loop
+    plan = await asyncio.to_thread(BatchPlan, system_prompt, user_prompts, batch_size, deadline)
+    for batch_round in range(LLM_BATCH_ROUNDS):
+        if not plan.pending or plan.past_deadline():
+            break
+        batches = plan.batches()
+        answers = await asyncio.gather(
+            *[ask_openai_batch_once_async(openai_client, system_prompt, batch, deadline=deadline)
+              for batch in batches])
+        await asyncio.to_thread(plan.record_round, batches, answers)
+
+    async def ask_leftover(task_id):
+        try:
+            return await ask_openai_async(openai_client, system_prompt, plan.pending[task_id], deadline=deadline)
+        except LLMError as task_error:
+            print(f"Error: {task_error}")
+            return None
+
+    # anything still missing is asked for on its own
+    leftover = plan.leftover()
+    plan.record_leftover(leftover, await asyncio.gather(*[ask_leftover(task_id) for task_id in leftover]))
+    return plan.finish()
@@ -0,0 +1,133 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, from a cached sheet lookup up to a report waiting on a slow model
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []  # every metric rendered by /metrics, in registration order
+# stage timings of the report being generated in this context (a thread, or a request on the async server --
+# asyncio.to_thread carries it along), see timings
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    """a value per label set that only goes up"""
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}  # sorted label items -> value
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Histogram:
+    """counts of observed values per bucket, plus their sum and count, per label set"""
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        self.values = {}  # sorted label items -> [count per bucket, sum, count]
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0, 0)
+            counts = [bucket_count + (value <= bucket) for bucket_count, bucket in zip(counts, self.buckets)]
+            self.values[key] = [counts, total + value, count + 1]
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                for bucket, bucket_count in zip(self.buckets, counts):  # counts are already cumulative
+                    samples.append((f"{self.name}_bucket", labels + (('le', bucket),), bucket_count))
+                samples.append((f"{self.name}_bucket", labels + (('le', '+Inf'),), count))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, count))
+        return samples
+
+
+class Callback:
+    """values read when /metrics is scraped -- collect returns [(labels dict, value)]"""
+
+    def __init__(self, name, documentation, kind, collect):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.collect = collect
+        registry.append(self)
+
+    def samples(self):
+        return [(self.name, tuple(sorted(labels.items())), value) for labels, value in self.collect()]
+
+
+def render():
+    """every registered metric in the prometheus text format"""
+    lines = []
+    for metric in registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = Histogram('ppp_stage_seconds', 'Time spent in each stage of generating a PPP.')
+llm_request_seconds = Histogram('ppp_llm_request_seconds', 'Latency of each chat completion attempt.')
+llm_tokens = Counter('ppp_llm_tokens_total', 'Tokens openai reported using, by prompt/completion.')
+llm_retries = Counter('ppp_llm_retries_total', 'Chat completions retried, by the error that caused the retry.')
+llm_hedges = Counter('ppp_llm_hedges_total', 'Slow chat completions sent a second time.')
+fallback_tasks = Counter('ppp_fallback_tasks_total', 'Tasks formatted locally because openai did not format them.')
+
+
+@contextmanager
+def stage(name):
+    """times a pipeline stage into ppp_stage_seconds and the current request's timings"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, stage=name)
+        stages = request_timings.get()
+        if stages is not None:
+            stages[name] = stages.get(name, 0) + elapsed
+
+
+def describe(stages, total):
+    """one line summary of a report's stage timings, for the timing footer"""
+    return f"Generated in {total:.2f}s: " + ', '.join(f"{name} {seconds:.2f}s" for name, seconds in stages.items())
+
+
+@contextmanager
+def timings():
+    """collects the stages timed in this context while the block runs -- yields {stage: seconds}"""
+    stages = {}
+    token = request_timings.set(stages)
+    try:
+        yield stages
+    finally:
+        request_timings.reset(token)
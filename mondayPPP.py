@@ -1,117 +1,112 @@
+import asyncio
+import io
+import json
+import os
+import time
+import numpy as np
 import pandas as pd
+import metrics
+from openpyxl import load_workbook
 from datetime import datetime, timedelta
-import openai
-import requests
-from config import OPENAI_API_KEY
-
+from cache import DiskCache, content_key
+from config import (OPENAI_MODEL, LLM_BATCH_SIZE, REPORT_DEADLINE, CACHE_DIR, SHEET_CACHE_MAX_ENTRIES,
+                    PROMPT_FIELDS, PROMPT_FIELD_MAX_TOKENS, REPORT_CACHE_MAX_ENTRIES, REPORT_CACHE_MAX_BYTES,
+                    REPORT_CACHE_MAX_AGE_DAYS, SNAPSHOT_MAX_ENTRIES, SNAPSHOT_MAX_BYTES, SNAPSHOT_MAX_AGE_DAYS,
+                    STREAMING_MIN_BYTES, STREAMING_CHUNK_ROWS, TIMING_FOOTER)
+from llm import (LLMError, ask_openai, ask_openai_async, ask_openai_batch, ask_openai_batch_async, dispatcher,
+                 get_async_client, get_client, task_cache, task_key)
+from prompts import build_task_prompt, fallback_task, has_fallbacks, log_prompt_tokens
+from workbook import SheetCache, read_workbook, workbook_hash
+
+
+# static, nothing task specific goes in here -- every request starts with the same bytes,
+# which lets openai reuse its cached prefix
+SYSTEM_PROMPT = (
+    "You are an expert in summarizing and restructuring tasks.\n"
+    "Your purpose is to analyze the provided details for a task, and "
+    "extract critical information that is important and relevant for an executive summary.\n"
+    "NOTE: keep GOAL and SUMMARY simple, concise, and easy to understand."
+    "1. Identify the name of this task and what department it belongs to."
+    " Come up with an overall business goal/objective/ corporate initiative for this task"
+    " using the name and department of the task. "
+    "This field is called GOAL.\n"
+    "2. Identify the subitems/ sub-tasks and the name of this task and"
+    " in your own words define what this task is specifically in a 1-10 word sentence. "
+    " Only cover what would be relevant for an executive. "
+    "This field is called SUMMARY.\n"
+    "3. Identify which individual(s) is/ are in charge of driving/ completing this task (DRI). "
+    "This field is called ASSIGNEE.\n"
+    "4. FORMAT YOUR RESPONSE: format the fields identified in steps 1-3 in your response. Use this syntax:\n"
+    "<b>{GOAL}</b>: {SUMMARY} <span class='assignee'>[{ASSIGNEE}]</span>\n"
+    "NOTE: fields are enclosed in curly brackets {}. "
+    "Replace the fields enclosed in curly brackets with the information you've identified.\n"
+    "\n"
+    "Example of how information for a task may be given: \n"
+    "- Name: Internship Training Program Mission Control Access\n"
+    "- Department: Internship Program\n"
+    "- Subitems: Configure Mission Control access,"
+    " give phase one interns access to Mission Control trainings,"
+    " give phase two interns access to Mission Control trainings,"
+    " give phase three interns access to Mission Control trainings\n"
+    "- DRI: Program Lead\n"
+    "Here is an example of how a task should be formatted in your response: \n"
+    "<b>Internship Training Program</b>:"
+    " Give all interns access to Mission Control trainings <span class='assignee'>[Program Lead]</span>\n"
+)
+
+
+def task_prompt(row):
+    """task information sent to openai for a row -- only its PROMPT_FIELDS, see prompts.build_task_prompt"""
+    return build_task_prompt(row)
+
+
+def decorate_task(row, task, has_og_target_date, has_comments, is_blocked=False, is_overdue=False):
+    """wraps a formatted task with its target date and blocked/ overdue markers
+    (a task openai didn't format, task None, is formatted locally)"""
+    if task is None:
+        task = fallback_task(row)
+    if pd.notna(row['Timeline']):
+        target_date = f"<span class='date'>{row['Timeline'].strftime('%-m/%-d')}</span> "
+    else:  # no target date (e.g. a blocked task without a timeline)
+        target_date = ""
+    if has_og_target_date and pd.notna(row['Original Target Date']):  # task has an original target date to include
+        og_target_date = f"<span class='og-date'>({row['Original Target Date'].strftime('%-m/%-d')})</span> "
+    else:
+        og_target_date = ""
+    if is_blocked:  # task is blocked
+        if has_comments and pd.notna(row['Comments']):
+            blocked = f"<span class='red-text'>({row['Comments']})</span> "
+        else:
+            blocked = "<span class='red-text'>(blocked)</span> "
+    else:
+        blocked = ""
+    if is_overdue:  # task is overdue
+        overdue = "<span class='red-text'>(overdue)</span>"
+    else:
+        overdue = ""
 
-# debugging connection errors
-print(f"OpenAI library version: {openai.__version__}")
-print(f"API Key (first 5 chars): {OPENAI_API_KEY[:5]}...")
-try:
-    response = requests.get("https://api.openai.com/v1/engines",
-                            headers={"Authorization": f"Bearer {OPENAI_API_KEY}"})
-    print(f"OpenAI API response status: {response.status_code}")
-    print(f"OpenAI API response: {response.text[:100]}...")  # Print first 100 chars
-except requests.RequestException as request_error:
-    print(f"Error reaching OpenAI API: {request_error}")
+    return f"{target_date}{og_target_date}{task} {blocked}{overdue}", row['Timeline']
 
 
-# configuring openAI access
-openai.api_key = OPENAI_API_KEY
-client = openai.OpenAI()  # creating an OpenAI client instance
+def by_target_date(task):
+    """sort key for formatted tasks, tasks without a target date go last"""
+    return task[1] if pd.notna(task[1]) else pd.Timestamp.max
 
 
-def ask_openai(openai_client, system_prompt, user_prompt):
-    """calls openai"""
-    try:
-        completion = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            temperature=0,
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                {
-                    "role": "user",
-                    "content": f"Here is the task information: {user_prompt}"
-                }
-            ]
-        )
-        return completion.choices[0].message.content
-    # debugging
-    except Exception as openai_error:
-        return f"Unexpected error: {openai_error}"
-
-
-def format_task(row, has_og_target_date, has_comments, is_blocked=False, is_overdue=False):
+def format_task(row, has_og_target_date, has_comments, is_blocked=False, is_overdue=False, deadline=None):
     """formats the progress, plan, and overdue tasks using AI"""
     try:
-        target_date = row['Timeline'].strftime('%-m/%-d')
-        if has_og_target_date and pd.notna(row['Original Target Date']):  # task has an original target date to include
-            og_target_date = f"<span class='og-date'>({row['Original Target Date'].strftime('%-m/%-d')})</span> "
-        else:
-            og_target_date = ""
-        if is_blocked:  # task is blocked
-            if has_comments and pd.notna(row['Comments']):
-                blocked = f"<span class='red-text'>({row['Comments']})</span> "
-            else:
-                blocked = "<span class='red-text'>(blocked)</span> "
-        else:
-            blocked = ""
-        if is_overdue:  # task is overdue
-            overdue = "<span class='red-text'>(overdue)</span>"
-        else:
-            overdue = ""
-
-        # setting AI prompts up
-        user_prompt = row.to_dict()
-        system_prompt = (
-            "You are an expert in summarizing and restructuring tasks.\n"
-            "Your purpose is to analyze the provided details for a task, and "
-            "extract critical information that is important and relevant for an executive summary.\n"
-            "NOTE: keep GOAL and SUMMARY simple, concise, and easy to understand."
-            "1. Identify the name of this task and what department it belongs to."
-            " Come up with an overall business goal/objective/ corporate initiative for this task"
-            " using the name and department of the task. "
-            "This field is called GOAL.\n"
-            "2. Identify the subitems/ sub-tasks and the name of this task and"
-            " in your own words define what this task is specifically in a 1-10 word sentence. "
-            " Only cover what would be relevant for an executive. "
-            "This field is called SUMMARY.\n"
-            "3. Identify which individual(s) is/ are in charge of driving/ completing this task (DRI). "
-            "This field is called ASSIGNEE.\n"
-            "4. FORMAT YOUR RESPONSE: format the fields identified in steps 1-3 in your response. Use this syntax:\n"
-            "<b>{GOAL}</b>: {SUMMARY} <span class='assignee'>[{ASSIGNEE}]</span>\n"
-            "NOTE: fields are enclosed in curly brackets {}. "
-            "Replace the fields enclosed in curly brackets with the information you've identified.\n"
-            "\n"
-            "Example of how information for a task may be given: \n"
-            "- Name: Internship Training Program Mission Control Access\n"
-            "- Department: Internship Program\n"
-            "- Subitems: Configure Mission Control access,"
-            " give phase one interns access to Mission Control trainings,"
-            " give phase two interns access to Mission Control trainings,"
-            " give phase three interns access to Mission Control trainings\n"
-            "- DRI: Program Lead\n"
-            "Here is an example of how a task should be formatted in your response: \n"
-            "<b>Internship Training Program</b>:"
-            " Give all interns access to Mission Control trainings <span class='assignee'>[Program Lead]</span>\n"
-        )
-
-        # asking AI
-        task = ask_openai(client, system_prompt, user_prompt)
-        print(task)
-
-        return f"<span class='date'>{target_date}</span> {og_target_date}{task} {blocked}{overdue}", row['Timeline']
-
-    except Exception as formatting_error:
-        return f"Error formatting task: {formatting_error}"
+        task = ask_openai(get_client(), SYSTEM_PROMPT, task_prompt(row), deadline=deadline)
+    except LLMError as task_error:
+        print(f"Error: {task_error} -- formatting the task locally")
+        metrics.fallback_tasks.inc()
+        task = None
+    print(task)
+    return decorate_task(row, task, has_og_target_date, has_comments, is_blocked=is_blocked, is_overdue=is_overdue)
 
 
 def to_datetime(timeline):
-    """returns the latest date in a cell as a datetime"""
+    """returns the latest date in a cell as a datetime (one cell at a time, see parse_timelines)"""
     # check if cell is empty
     if pd.isna(timeline) or timeline.strip() == "":
         return pd.NaT  # skip empty or NaN cells
@@ -120,122 +115,693 @@ def to_datetime(timeline):
     return converted_dates.max()  # get the latest date
 
 
-def create_ppp(file_path, audience, pg=None):
-    """takes a file path and a page to an Excel sheet (provided optionally)
-    and generates a PPP for it"""
+# pandas 2 infers a single date format for a whole column unless told otherwise,
+# pandas 1 parses every value on its own (like to_datetime does cell by cell)
+MIXED_DATE_FORMATS = {'format': 'mixed'} if int(pd.__version__.split('.')[0]) >= 2 else {}
+
+
+def parse_timelines(timelines):
+    """vectorized to_datetime for a whole Timeline column -- the latest date in every cell, NaT for blank cells.
+    a cell may list several dates separated by commas, or be a Monday date range ('2024-07-01 - 2024-07-15'),
+    which gives its end date (to_datetime misread ranges, see benchmark.bench_timeline)"""
+    cells = timelines.reset_index(drop=True).dropna().astype(str)  # positions, in case the index repeats
+    dates = cells.str.split(r',|\s+-\s+').explode().str.strip()  # one row per date, still labelled by cell
+    unique_dates = dates.unique()
+    parsed = pd.Series(pd.to_datetime(unique_dates, errors='coerce', **MIXED_DATE_FORMATS), index=unique_dates)
+    latest = dates.map(parsed).groupby(level=0).max()  # get the latest date in each cell
+    return pd.Series(latest.reindex(range(len(timelines))).values, index=timelines.index,
+                     dtype='datetime64[ns]', name=timelines.name)
+
+
+REQUIRED_COLUMNS = ['Status', 'Timeline', 'Completed Date', 'Audience']
+# columns read from a board export, the rest of the sheet is never kept
+SHEET_COLUMNS = ['Name'] + REQUIRED_COLUMNS + ['Original Target Date', 'Comments'] + PROMPT_FIELDS
+# columns decorate_task and task_prompt read, what stream_tasks keeps of a reported task
+RECORD_COLUMNS = ['Timeline', 'Original Target Date', 'Comments'] + PROMPT_FIELDS
+SHEET_FORMAT = 2  # bump when normalize_sheet changes, so cached sheets are parsed again
+
+# parsed sheets keyed by workbook contents, sheet and columns
+sheet_cache = SheetCache(os.path.join(CACHE_DIR, 'sheets'), max_entries=SHEET_CACHE_MAX_ENTRIES)
+
+
+def cache_lookups():
+    """hit/miss counts of the task, sheet and report caches, for /metrics"""
+    lookups = []
+    for cache, stats in [('task', task_cache.stats()), ('sheet', sheet_cache.stats()),
+                         ('report', report_cache.stats())]:
+        lookups.append(({'cache': cache, 'result': 'hit'}, stats['hits']))
+        lookups.append(({'cache': cache, 'result': 'miss'}, stats['misses']))
+    return lookups
+
+
+metrics.Callback('ppp_cache_lookups_total', 'Task, sheet and report cache lookups in this process.', 'counter',
+                 cache_lookups)
+
+
+def cache_sizes():
+    """entries and bytes of the task and report caches, for /metrics (read when scraped, not per report)"""
+    sizes = []
+    for cache, stats in [('task', task_cache.stats()), ('report', report_cache.stats())]:
+        sizes.append(({'cache': cache, 'unit': 'entries'}, stats['entries']))
+        sizes.append(({'cache': cache, 'unit': 'bytes'}, stats['bytes']))
+    return sizes
+
+
+metrics.Callback('ppp_cache_size', 'Entries and bytes in the shared task and report cache files.', 'gauge',
+                 cache_sizes)
+
+
+def drop_non_tasks(df):
+    """filters rows that aren't project tasks (group headers, subitems, blank rows)"""
+    # as text (a chunk of numeric names has no .str), stripped once, compared against the few distinct names
+    name = df['Name'].astype(str).str.strip().astype('category')
+    return df[df['Name'].notna() & ~name.isin(['', 'Subitems', 'Name', 'Review', 'Closed'])]
+
+
+def parse_dates(df):
+    """parses the Timeline and Completed Date columns of the task rows (of one audience, see audience_tasks)"""
+    return df.assign(**{
+        'Timeline': parse_timelines(df['Timeline']),  # find latest date in timeline column
+        'Completed Date': pd.to_datetime(df['Completed Date'], format='%m/%d/%Y', errors='coerce')  # convert
+    })
+
+
+def normalize_sheet(df):
+    """keeps only the project task rows of a board export -- their dates are parsed once the rows are
+    filtered to an audience (audience_tasks), so a report for one audience doesn't parse everyone's"""
+    return drop_non_tasks(df)
+
+
+def parse_sheet(data, pg=None):
+    """reads the board columns of a Monday.com board export (a page of it, optionally) from its contents"""
+    # open file and skip first four rows:
+    # - row 1: '24Q3 Review Portfolio'-- board name
+    # - row 2: 'A high level overview of all your upcoming, current and completed projects.'-- board description
+    # - row 3: blank spacer
+    # - row 4: 'Committed'-- data frame is sorted by column 'Status'
+    # (pg is the page to the Excel sheet, the first page when not provided)
+    df = pd.read_excel(io.BytesIO(data), sheet_name=pg or 0, skiprows=4,
+                       usecols=lambda column: column in SHEET_COLUMNS)
+
+    # checking for required columns for PPP report
+    missing_columns = [col for col in REQUIRED_COLUMNS if col not in df.columns]
+    if missing_columns:  # missing columns
+        raise Exception(f"Missing required columns: {', '.join(missing_columns)}")
+    return df
+
+
+def read_sheet(workbook, pg=None):
+    """reads a Monday.com board export (a page of it, optionally) and keeps only its project task rows.
+    workbook is the upload's contents, a file-like object or a path -- parsed sheets are cached by content,
+    so asking for another sheet or audience of the same workbook skips Excel parsing"""
+    data = read_workbook(workbook)
+    key = content_key(workbook_hash(data), pg or 0, SHEET_COLUMNS, SHEET_FORMAT)
+    df = sheet_cache.get(key)
+    if df is not None:
+        return df
+
+    with metrics.stage('parse_excel'):
+        df = parse_sheet(data, pg)
+    with metrics.stage('normalize_sheet'):
+        df = normalize_sheet(df)
+    sheet_cache.put(key, df)
+    return df
+
+
+# PPP sections a task can fall into, in report order, and how each one is formatted
+SECTIONS = ['progress', 'plan', 'blocked', 'overdue']
+SECTION_JOBS = {
+    'progress': ('progress', {}),
+    'plan': ('plan', {}),
+    'blocked': ('problems', {'is_blocked': True}),
+    'overdue': ('problems', {'is_overdue': True})
+}
+
+
+def classify_tasks(status, timeline, completed_date, today=None):
+    """the PPP section of every task in one vectorized pass (NaN for tasks that aren't reported):
+    progress -- 'Completed' (completed within the last week)
+    plan -- 'Working', 'Committed', 'Completed - Partial' (target date is in the next two months)
+    blocked -- 'Blocked'
+    overdue -- target date has passed and the task isn't completed, soft committed, deprioritized,
+    canceled, in review or blocked"""
+    # get range of dates for progress and plan sections
+    today = today or datetime.now().date()  # today's date
+    last_week = today - timedelta(days=7)  # 7 days ago
+    two_months = today + timedelta(days=60)  # 60 days from now
+
+    # convert dates without time component
+    today = datetime.combine(today, datetime.min.time())
+    last_week = datetime.combine(last_week, datetime.min.time())
+    two_months = datetime.combine(two_months, datetime.min.time())
+
+    status = status.astype('category')  # compare codes instead of strings
+    codes = np.select([
+        (status == 'Completed') & (completed_date >= last_week) & (completed_date <= today),
+        status.isin(['Working', 'Committed', 'Completed - Partial']) & (timeline > today) & (timeline <= two_months),
+        status == 'Blocked',
+        (timeline <= today) & ~status.isin(['Completed', 'Soft Commit', 'Deprioritized', 'Canceled', 'Review',
+                                            'Blocked'])
+    ], range(len(SECTIONS)), default=-1).astype('int8')
+    return pd.Series(pd.Categorical.from_codes(codes, categories=SECTIONS), index=status.index)
+
+
+def audience_rows(df, audience):
+    """the tasks of a normalized sheet shown to audience ('Everyone' sees every task)"""
+    if audience != 'Everyone':  # if there is a specified audience
+        df = df[df['Audience'].str.strip() == audience]
+    return df
+
+
+def audience_tasks(df, audience):
+    """the tasks of a normalized sheet shown to audience, with their dates parsed"""
+    return parse_dates(audience_rows(df, audience))
+
+
+def section_jobs(df, sections):
+    """(section, task record, format_task flags) jobs for the reported tasks, in report order"""
+    # only the reported tasks are turned into records for the formatter
+    reported = sections.notna()
+    records = df[reported].to_dict('records')
+    sections = sections[reported]
+    return [(SECTION_JOBS[section][0], record, SECTION_JOBS[section][1])
+            for section in SECTIONS
+            for record, task_section in zip(records, sections) if task_section == section]
+
+
+def select_tasks(df, audience, today=None):
+    """picks the tasks of a normalized sheet for each PPP section -- returns (section, task record,
+    format_task flags) jobs, plus whether the optional Original Target Date and Comments columns exist"""
+    df = audience_tasks(df, audience)
+    sections = classify_tasks(df['Status'], df['Timeline'], df['Completed Date'], today)
+
+    # check for optionally existing columns: comments or original target date
+    has_og_target_date = 'Original Target Date' in df.columns
+    has_comments = 'Comments' in df.columns
+
+    return section_jobs(df, sections), has_og_target_date, has_comments
+
+
+def sheet_chunks(data, pg=None, chunk_rows=STREAMING_CHUNK_ROWS):
+    """reads the board columns of a Monday.com board export (xlsx) row by row, like parse_sheet but without
+    ever holding the whole sheet -- yields data frames of up to chunk_rows sheet rows"""
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
     try:
-        # open file and skip first four rows:
-        # - row 1: '24Q3 Review Portfolio'-- board name
-        # - row 2: 'A high level overview of all your upcoming, current and completed projects.'-- board description
-        # - row 3: blank spacer
-        # - row 4: 'Committed'-- data frame is sorted by column 'Status'
-        if pg:  # page to Excel sheet provided
-            df = pd.read_excel(file_path, sheet_name=pg, skiprows=4)
-        else:  # no page to Excel sheet provided
-            df = pd.read_excel(file_path, skiprows=4)
+        if pg and pg not in workbook.sheetnames:
+            raise ValueError(f"Worksheet named '{pg}' not found")  # what read_excel says
+        worksheet = workbook[pg] if pg else workbook.worksheets[0]
+        rows = worksheet.iter_rows(min_row=5, values_only=True)  # the header row, see parse_sheet
+        header = next(rows, ())
+        columns = {}
+        for position, column in enumerate(header):
+            if column in SHEET_COLUMNS:
+                columns.setdefault(column, position)
 
         # checking for required columns for PPP report
-        required = ['Status', 'Timeline', 'Completed Date', 'Audience']
-        missing_columns = [col for col in required if col not in df.columns]
+        missing_columns = [col for col in REQUIRED_COLUMNS if col not in columns]
         if missing_columns:  # missing columns
             raise Exception(f"Missing required columns: {', '.join(missing_columns)}")
 
-        # Filter rows that aren't project tasks
-        df = df[~df['Name'].isna() &
-                (df['Name'].str.strip() != '') &
-                (df['Name'].str.strip() != 'Subitems') &
-                (df['Name'].str.strip() != 'Name') &
-                (df['Name'].str.strip() != 'Review') &
-                (df['Name'].str.strip() != 'Closed')]
-
-        if audience != 'Everyone':  # if there is a specified audience
-            df = df[df['Audience'].str.strip() == audience]
-
-        df['Timeline'] = df['Timeline'].apply(to_datetime)  # find latest date in timeline column
-        df['Completed Date'] = pd.to_datetime(df['Completed Date'], format='%m/%d/%Y', errors='coerce')  # convert
-
-        # get range of dates for progress and plan sections
-        today = datetime.now().date()  # today's date
-        last_week = today - timedelta(days=7)  # 7 days ago
-        two_months = today + timedelta(days=60)  # 60 days from now
-
-        # convert dates without time component
-        today = datetime.combine(today, datetime.min.time())
-        last_week = datetime.combine(last_week, datetime.min.time())
-        two_months = datetime.combine(two_months, datetime.min.time())
-
-        # getting tasks for each section
-        # progress -- ‘Completed’ (target date is within last week)
-        # plan -- ‘Working’, ‘Committed’, ‘Completed - Partial’ (target date is in next two months)
-        # problems -- 'Blocked' or overdue
-
-        progress_section = df[(df['Status'] == 'Completed') &
-                              (df['Completed Date'] >= last_week) &
-                              (df['Completed Date'] <= today)]
-        plan_section = df[((df['Status'] == 'Working') |
-                          (df['Status'] == 'Committed') |
-                          (df['Status'] == 'Completed - Partial')) &
-                          ((df['Timeline'] > today) &
-                          (df['Timeline'] <= two_months))]
-        blocked_section = df[df['Status'] == 'Blocked']
-        overdue_section = df[(df['Timeline'] <= today) &
-                             (df['Status'] != 'Completed') &
-                             (df['Status'] != 'Soft Commit') &
-                             (df['Status'] != 'Deprioritized') &
-                             (df['Status'] != 'Canceled') &
-                             (df['Status'] != 'Review') &
-                             (df['Status'] != 'Blocked')]
-
-        # check for optionally existing columns: comments or original target date
+        chunk = []
+        chunks = 0
+        for row in rows:
+            chunk.append([row[position] if position < len(row) else None for position in columns.values()])
+            if len(chunk) == chunk_rows:
+                yield pd.DataFrame.from_records(chunk, columns=list(columns))
+                chunk = []
+                chunks += 1
+        if chunk or not chunks:  # an empty sheet is still one (empty) chunk with the sheet's columns
+            yield pd.DataFrame.from_records(chunk, columns=list(columns))
+    finally:
+        workbook.close()
+
+
+def stream_tasks(data, audience, pg=None, today=None, chunk_rows=STREAMING_CHUNK_ROWS):
+    """select_tasks for a sheet read with sheet_chunks: every chunk is normalized, filtered to audience and
+    classified as it is read, and only the reported tasks' records are kept"""
+    today = today or datetime.now().date()  # the same day for every chunk
+    reported = {section: [] for section in SECTIONS}
+    columns = []
+    for chunk in sheet_chunks(data, pg, chunk_rows):
+        columns = chunk.columns
+        df = audience_tasks(normalize_sheet(chunk), audience)
+        sections = classify_tasks(df['Status'], df['Timeline'], df['Completed Date'], today)
+        df = df[[column for column in df.columns if column in RECORD_COLUMNS]]
+        for section in SECTIONS:
+            reported[section] += df[sections == section].to_dict('records')
+
+    # check for optionally existing columns: comments or original target date
+    has_og_target_date = 'Original Target Date' in columns
+    has_comments = 'Comments' in columns
+
+    jobs = [(SECTION_JOBS[section][0], record, SECTION_JOBS[section][1])
+            for section in SECTIONS for record in reported[section]]
+    return jobs, has_og_target_date, has_comments
+
+
+def read_tasks(workbook, audience, pg=None):
+    """read_sheet and select_tasks, the pandas half of a report -- large xlsx workbooks (STREAMING_MIN_BYTES)
+    are read with stream_tasks instead"""
+    data = read_workbook(workbook)
+    if len(data) >= STREAMING_MIN_BYTES and data[:2] == b'PK':  # xlsx files are zip archives
+        with metrics.stage('stream_tasks'):
+            return stream_tasks(data, audience, pg)
+    df = read_sheet(data, pg)
+    with metrics.stage('select_tasks'):
+        return select_tasks(df, audience)
+
+
+def report_deadline():
+    """deadline (a time.monotonic() value) for a report starting now, None without REPORT_DEADLINE"""
+    return time.monotonic() + REPORT_DEADLINE if REPORT_DEADLINE else None
+
+
+# changes whenever the same task would be formatted differently, so stored formatted tasks can't be reused
+PROMPT_VERSION = content_key(SYSTEM_PROMPT, PROMPT_FIELDS, PROMPT_FIELD_MAX_TOKENS, OPENAI_MODEL)
+
+# finished reports keyed by report_key: [progress_output, plans_output, problems_output]
+report_cache = DiskCache(os.path.join(CACHE_DIR, 'reports.sqlite3'), max_entries=REPORT_CACHE_MAX_ENTRIES,
+                         max_bytes=REPORT_CACHE_MAX_BYTES, max_age=REPORT_CACHE_MAX_AGE_DAYS * 24 * 60 * 60)
+
+
+def report_key(workbook, audience, pg=None, today=None):
+    """report cache key: the workbook's contents, the sheet and audience, the day the report is for
+    (the sections depend on today's date) and PROMPT_VERSION"""
+    today = today or datetime.now().date()
+    return content_key(workbook_hash(read_workbook(workbook)), pg or 0, audience, today.isoformat(), PROMPT_VERSION)
+
+
+def cached_report(key):
+    """the cached report for key, {'outputs': (progress_output, plans_output, problems_output), 'etag'}, or None"""
+    value = report_cache.get(key)
+    if value is None:
+        return None
+    return {'outputs': tuple(json.loads(value)), 'etag': content_key(value)[:32]}
+
+
+def lookup_report(workbook, audience, pg=None):
+    """(the workbook's bytes, its report key, the cached report's outputs or None) before generating a report"""
+    data = read_workbook(workbook)
+    key = report_key(data, audience, pg)
+    cached = cached_report(key)
+    return data, key, cached['outputs'] if cached is not None else None
+
+
+def has_report(key):
+    """whether a report is cached for key, without counting a cache lookup"""
+    return report_cache.lookup(key) is not None
+
+
+def store_report(key, report):
+    """caches a finished report -- unless openai didn't format some of its tasks, those are asked for again"""
+    if not any(has_fallbacks(output) for output in report):
+        report_cache.set(key, json.dumps(list(report)))
+
+
+def summarize_tasks(prompts, batch_size=LLM_BATCH_SIZE, deadline=None):
+    """asks openai to format every {task id: task prompt} -- tasks are sent concurrently (see llm.Dispatcher),
+    either batch_size tasks per call or one call per task. returns {task id: formatted task}, where tasks
+    openai didn't format (before deadline) are None -- decorate_task formats those locally"""
+    if batch_size > 1:
+        tasks, _ = ask_openai_batch(get_client(), SYSTEM_PROMPT, prompts, batch_size=batch_size, deadline=deadline)
+    else:
+        def ask(task_id):
+            try:
+                return ask_openai(get_client(), SYSTEM_PROMPT, prompts[task_id], deadline=deadline)
+            except LLMError as task_error:
+                print(f"Error: {task_error}")
+                return None
+
+        task_ids = list(prompts)
+        tasks = dict(zip(task_ids, dispatcher.map(ask, task_ids)))
+    return count_fallbacks(tasks)
+
+
+def count_fallbacks(tasks):
+    """counts the tasks openai didn't format (None) -- returns tasks"""
+    fallbacks = sum(task is None for task in tasks.values())
+    if fallbacks:
+        print(f"{fallbacks} task(s) weren't formatted by openai in time, formatting them locally")
+        metrics.fallback_tasks.inc(fallbacks)
+    return tasks
+
+
+def job_prompts(jobs):
+    """{task id: task prompt} of every job, the task id being its position"""
+    prompts = {str(i): task_prompt(job[1]) for i, job in enumerate(jobs)}
+    log_prompt_tokens([job[1] for job in jobs], prompts.values())
+    return prompts
+
+
+def prompt_batches(prompts, batch_size=LLM_BATCH_SIZE):
+    """{task id: task prompt} split into dicts of batch_size tasks, in order -- what stream_ppp sends together"""
+    task_ids = list(prompts)
+    return [{task_id: prompts[task_id] for task_id in task_ids[start:start + batch_size]}
+            for start in range(0, len(task_ids), max(batch_size, 1))]
+
+
+def format_tasks(jobs, has_og_target_date, has_comments, batch_size=LLM_BATCH_SIZE, deadline=None):
+    """formats every job, results keep the order of jobs"""
+    tasks = summarize_tasks(job_prompts(jobs), batch_size=batch_size, deadline=deadline)
+    return [decorate_task(job[1], tasks[str(i)], has_og_target_date, has_comments, **job[2])
+            for i, job in enumerate(jobs)]
+
+
+def assemble_ppp(jobs, formatted):
+    """sorts each section's formatted tasks by target date and joins them into the report html"""
+    progress_tasks = [task for job, task in zip(jobs, formatted) if job[0] == 'progress']
+    plan_tasks = [task for job, task in zip(jobs, formatted) if job[0] == 'plan']
+    problem_tasks = [task for job, task in zip(jobs, formatted) if job[0] == 'problems']
+
+    # sorting tasks for each section by target date
+    progress = sorted(progress_tasks, key=by_target_date)
+    plan = sorted(plan_tasks, key=by_target_date)
+    problems = sorted(problem_tasks, key=by_target_date)
+
+    # formatting PPP
+    progress_output = "<br>".join(f"  •  {task[0]}" for task in progress)
+    plans_output = "<br>".join(f"  • {task[0]}" for task in plan)
+    problems_output = "<br>".join(f"  • {task[0]}" for task in problems)
+
+    # Check if sections are empty and set default message if so
+    if not progress_output:
+        progress_output = "No tasks completed within the last week."
+    else:
+        progress_output += "<br><br>"
+
+    if not plans_output:
+        plans_output = "Nothing planned for the next two months."
+    else:
+        plans_output += "<br><br>"
+
+    if not problems_output:
+        problems_output = "No blocked or overdue projects."
+    else:
+        problems_output += "<br><br>"
+
+    return progress_output, plans_output, problems_output
+
+
+def create_ppp(workbook, audience, pg=None, batch_size=LLM_BATCH_SIZE):
+    """takes a workbook (contents, file-like object or path) and a page to an Excel sheet (provided optionally)
+    and generates a PPP for it -- batch_size tasks share one openai call (1 asks per task).
+    tasks openai hasn't formatted by REPORT_DEADLINE are formatted locally.
+    a report generated earlier today from the same workbook, sheet and audience comes from report_cache"""
+    try:
+        deadline = report_deadline()
+        data, key, cached = lookup_report(workbook, audience, pg)
+        if cached is not None:
+            return cached
+        jobs, has_og_target_date, has_comments = read_tasks(data, audience, pg)
+        with metrics.stage('format_tasks'):
+            formatted = format_tasks(jobs, has_og_target_date, has_comments, batch_size=batch_size,
+                                     deadline=deadline)
+        with metrics.stage('assemble_ppp'):
+            report = assemble_ppp(jobs, formatted)
+        store_report(key, report)
+        return report
+
+    except Exception as ppp_error:
+        print(f"Error: {ppp_error}")
+        raise
+
+
+def create_ppp_bundle(workbook, audiences, sheets=None, batch_size=LLM_BATCH_SIZE):
+    """generates a PPP for every sheet and audience asked for from one workbook (the first sheet when no
+    sheets are given). each sheet is parsed once and each distinct task is formatted once, however many
+    reports it shows up in -- returns a list of {sheet, audience, progress_output, plans_output, problems_output}"""
+    try:
+        deadline = report_deadline()
+        data = read_workbook(workbook)
+        reports = []
+        for sheet in sheets or [None]:
+            df = read_sheet(data, sheet)
+            for audience in audiences:
+                with metrics.stage('select_tasks'):
+                    reports.append((sheet, audience) + select_tasks(df, audience))
+
+        # a task in several reports (e.g. 'Everyone' and a specific audience) is one openai task
+        prompts = {}
+        rows = {}
+        for sheet, audience, jobs, has_og_target_date, has_comments in reports:
+            for job in jobs:
+                user_prompt = task_prompt(job[1])
+                prompts.setdefault(task_key(SYSTEM_PROMPT, user_prompt), user_prompt)
+                rows.setdefault(task_key(SYSTEM_PROMPT, user_prompt), job[1])
+        log_prompt_tokens(rows.values(), prompts.values())
+        with metrics.stage('format_tasks'):
+            tasks = summarize_tasks(prompts, batch_size=batch_size, deadline=deadline)
+
+        bundle = []
+        for sheet, audience, jobs, has_og_target_date, has_comments in reports:
+            with metrics.stage('assemble_ppp'):
+                formatted = [decorate_task(job[1], tasks[task_key(SYSTEM_PROMPT, task_prompt(job[1]))],
+                                           has_og_target_date, has_comments, **job[2])
+                             for job in jobs]
+                progress_output, plans_output, problems_output = assemble_ppp(jobs, formatted)
+            bundle.append({'sheet': sheet, 'audience': audience, 'progress_output': progress_output,
+                           'plans_output': plans_output, 'problems_output': problems_output})
+        return bundle
+
+    except Exception as ppp_error:
+        print(f"Error: {ppp_error}")
+        raise
+
+
+SECTION_TITLES = {'progress': 'Progress', 'plan': 'Plans', 'blocked': 'Problems (blocked)',
+                  'overdue': 'Problems (overdue)'}
+
+# snapshot of the last delta PPP of every board, sheet and audience:
+# {'prompt_version': ..., 'rows': {row key: [field hash, section or None, formatted task or None]}}
+snapshot_cache = DiskCache(os.path.join(CACHE_DIR, 'snapshots.sqlite3'), max_entries=SNAPSHOT_MAX_ENTRIES,
+                           max_bytes=SNAPSHOT_MAX_BYTES, max_age=SNAPSHOT_MAX_AGE_DAYS * 24 * 60 * 60)
+
+
+def row_keys(df):
+    """identifies every task across exports of a board: its name, numbered when several tasks share a name"""
+    names = df['Name'].astype(str).str.strip()
+    return names + '#' + names.groupby(names).cumcount().astype(str)
+
+
+def row_hashes(df):
+    """a hash of every task's prompt fields -- changes whenever what openai is told about the task does"""
+    fields = [field for field in PROMPT_FIELDS if field in df.columns]
+    return pd.util.hash_pandas_object(df[fields], index=False).astype(str)
+
+
+def describe_changes(previous_rows, rows, jobs, formatted):
+    """the 'what changed since the last run' section: reported tasks that are new, were updated or moved
+    to another section, then tasks that are no longer reported"""
+    changes = []
+    for job, task in zip(jobs, formatted):
+        key = job[1]['Row Key']
+        field_hash, section, _ = rows[key]
+        previous = previous_rows.get(key)
+        if previous is None:
+            changes.append(f"<span class='change'>new in {SECTION_TITLES[section]}</span> {task[0]}")
+        elif previous[0] != field_hash:
+            changes.append(f"<span class='change'>updated</span> {task[0]}")
+        elif previous[1] != section:
+            changes.append(f"<span class='change'>moved to {SECTION_TITLES[section]}</span> {task[0]}")
+    for key, (field_hash, section, _) in previous_rows.items():
+        if section is not None and rows.get(key, [None, None])[1] is None:
+            reason = 'removed from the board' if key not in rows else f"no longer in {SECTION_TITLES[section]}"
+            changes.append(f"<span class='change'>{reason}</span> {key.rsplit('#', 1)[0]}")
+
+    if not changes:
+        return "No changes since the last run."
+    return "<br>".join(f"  • {change}" for change in changes) + "<br><br>"
+
+
+def create_ppp_delta(workbook, audience, board, pg=None, batch_size=LLM_BATCH_SIZE):
+    """generates a PPP like create_ppp, but against the snapshot of board's last run (for the same sheet and
+    audience): every task is classified again, and only tasks that are new or whose prompt fields changed
+    are sent to openai. returns (progress_output, plans_output, problems_output, changes_output)"""
+    try:
+        deadline = report_deadline()
+        df = audience_tasks(read_sheet(workbook, pg), audience)
+        with metrics.stage('select_tasks'):
+            df = df.assign(**{'Row Key': row_keys(df)})
+            sections = classify_tasks(df['Status'], df['Timeline'], df['Completed Date'])
+            jobs = section_jobs(df, sections)
+            rows = {key: [field_hash, section, None] for key, field_hash, section in
+                    zip(df['Row Key'], row_hashes(df), sections.astype(object).where(sections.notna(), None))}
         has_og_target_date = 'Original Target Date' in df.columns
         has_comments = 'Comments' in df.columns
 
-        # formatting tasks for PPP
-        progress_tasks = [
-            format_task(row, has_og_target_date, has_comments)
-            for index, row in progress_section.iterrows()
-        ]
-        plan_tasks = [
-            format_task(row, has_og_target_date, has_comments)
-            for index, row in plan_section.iterrows()
-        ]
-        problem_tasks = [
-            format_task(row, has_og_target_date, has_comments, is_blocked=True)
-            for index, row in blocked_section.iterrows()
-        ] + [
-            format_task(row, has_og_target_date, has_comments, is_overdue=True)
-            for index, row in overdue_section.iterrows()
-        ]
-
-        # sorting tasks for each section by target date
-        progress = sorted(progress_tasks, key=lambda target_date: target_date[1])
-        plan = sorted(plan_tasks, key=lambda target_date: target_date[1])
-        problems = sorted(problem_tasks, key=lambda target_date: target_date[1])
-
-        # formatting PPP
-        progress_output = "<br>".join(f"  •  {task[0]}" for task in progress)
-        plans_output = "<br>".join(f"  • {task[0]}" for task in plan)
-        problems_output = "<br>".join(f"  • {task[0]}" for task in problems)
-
-        # Check if sections are empty and set default message if so
-        if not progress_output:
-            progress_output = "No tasks completed within the last week."
-        else:
-            progress_output += "<br><br>"
+        snapshot_key = content_key('snapshot', board, pg or 0, audience)
+        snapshot = json.loads(snapshot_cache.get(snapshot_key) or 'null')
+        previous_rows = snapshot['rows'] if snapshot else {}
+        reusable = snapshot is not None and snapshot['prompt_version'] == PROMPT_VERSION
+
+        # unchanged tasks keep last run's formatting, the rest go to openai (or the task cache)
+        tasks = {}
+        prompts = {}
+        for job in jobs:
+            key = job[1]['Row Key']
+            previous = previous_rows.get(key)
+            if reusable and previous and previous[0] == rows[key][0] and previous[2] is not None:
+                tasks[key] = previous[2]
+            else:
+                prompts[key] = task_prompt(job[1])
+        print(f"Delta mode: {len(rows)} row(s), {len(jobs)} reported, {len(tasks)} reused from the last run, "
+              f"{len(prompts)} new or changed")
+        with metrics.stage('format_tasks'):
+            if prompts:
+                log_prompt_tokens([job[1] for job in jobs if job[1]['Row Key'] in prompts], prompts.values())
+                tasks.update(summarize_tasks(prompts, batch_size=batch_size, deadline=deadline))
+
+        with metrics.stage('assemble_ppp'):
+            formatted = [decorate_task(job[1], tasks[job[1]['Row Key']], has_og_target_date, has_comments, **job[2])
+                         for job in jobs]
+            report = assemble_ppp(jobs, formatted)
+            if snapshot is None:
+                changes_output = "No earlier run of this board to compare against, the next run will list what changed."
+            else:
+                changes_output = describe_changes(previous_rows, rows, jobs, formatted)
 
-        if not plans_output:
-            plans_output = "Nothing planned for the next two months."
-        else:
-            plans_output += "<br><br>"
+        for key, task in tasks.items():
+            rows[key][2] = task
+        snapshot_cache.set(snapshot_key, json.dumps({'prompt_version': PROMPT_VERSION, 'rows': rows}))
+        return report + (changes_output,)
+
+    except Exception as ppp_error:
+        print(f"Error: {ppp_error}")
+        raise
+
+
+def stream_ppp(workbook, audience, pg=None, batch_size=LLM_BATCH_SIZE):
+    """generates a PPP like create_ppp, but yields the tasks of each batch (batch_size tasks share one openai
+    call, see summarize_tasks) as soon as openai has formatted it: ('task', section, html, target date) in
+    completion order, then ('report', (progress, plans, problems)) with every section sorted by target date
+    (only the report when it is cached, see create_ppp)"""
+    try:
+        deadline = report_deadline()
+        data, key, cached = lookup_report(workbook, audience, pg)
+        if cached is not None:
+            yield 'report', cached
+            return
+        jobs, has_og_target_date, has_comments = read_tasks(data, audience, pg)
+        formatted = [None] * len(jobs)
+        for _, tasks in dispatcher.map_as_completed(
+                lambda batch: summarize_tasks(batch, batch_size=batch_size, deadline=deadline),
+                prompt_batches(job_prompts(jobs), batch_size)):
+            for task_id, task in tasks.items():
+                i = int(task_id)
+                formatted[i] = decorate_task(jobs[i][1], task, has_og_target_date, has_comments, **jobs[i][2])
+                yield 'task', jobs[i][0], formatted[i][0], formatted[i][1]
+        report = assemble_ppp(jobs, formatted)
+        store_report(key, report)
+        yield 'report', report
 
-        if not problems_output:
-            problems_output = "No blocked or overdue projects."
+    except Exception as ppp_error:
+        print(f"Error: {ppp_error}")
+        raise
+
+
+def report_outputs(report):
+    """template variables for a generated report, with the changes section of a delta report"""
+    return dict(zip(['progress_output', 'plans_output', 'problems_output', 'changes_output'], report))
+
+
+class ReportEvents:
+    """the Server-Sent Events of a streamed report (see stream_ppp), timed from when the stream started --
+    shared by the /generatePPP/stream routes of app.py and asgi.py"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first_task = None  # ms until the first task was streamed
+
+    def event(self, frame, stages, report_url=None):
+        """the event for a stream_ppp frame -- stages are the report's metrics.timings(), report_url its
+        stable url once cached"""
+        elapsed_ms = round((time.perf_counter() - self.start) * 1000)
+        if frame[0] == 'task':
+            if self.first_task is None:
+                self.first_task = elapsed_ms
+                print(f"First PPP task streamed after {elapsed_ms} ms")
+            data = {'section': frame[1], 'html': frame[2], 'date': frame[3].isoformat(), 'elapsed_ms': elapsed_ms}
         else:
-            problems_output += "<br><br>"
+            data = dict(report_outputs(frame[1]), elapsed_ms=elapsed_ms, first_task_ms=self.first_task)
+            if TIMING_FOOTER:
+                data['timings'] = metrics.describe(stages, elapsed_ms / 1000)
+            data['report_url'] = report_url
+        return f"event: {frame[0]}\ndata: {json.dumps(data)}\n\n"
+
+    @staticmethod
+    def error(error):
+        return f"event: error\ndata: {json.dumps({'error': str(error)})}\n\n"
+
+
+# the async server (see asgi.py) -- the same pipeline, with the pandas work on worker threads and openai awaited,
+# so one process serves many reports while they wait on openai
+
+async def summarize_tasks_async(prompts, batch_size=LLM_BATCH_SIZE, deadline=None):
+    """summarize_tasks on the async openai client"""
+    if batch_size > 1:
+        tasks, _ = await ask_openai_batch_async(get_async_client(), SYSTEM_PROMPT, prompts, batch_size=batch_size,
+                                                deadline=deadline)
+    else:
+        async def ask(task_id):
+            try:
+                return await ask_openai_async(get_async_client(), SYSTEM_PROMPT, prompts[task_id], deadline=deadline)
+            except LLMError as task_error:
+                print(f"Error: {task_error}")
+                return None
+
+        task_ids = list(prompts)
+        tasks = dict(zip(task_ids, await asyncio.gather(*[ask(task_id) for task_id in task_ids])))
+    return count_fallbacks(tasks)
+
+
+async def create_ppp_async(workbook, audience, pg=None, batch_size=LLM_BATCH_SIZE):
+    """create_ppp for the async server -- Excel parsing and task selection run on a worker thread"""
+    try:
+        deadline = report_deadline()
+        data, key, cached = await asyncio.to_thread(lookup_report, workbook, audience, pg)  # sqlite, off the loop
+        if cached is not None:
+            return cached
+        jobs, has_og_target_date, has_comments = await asyncio.to_thread(read_tasks, data, audience, pg)
+        with metrics.stage('format_tasks'):
+            tasks = await summarize_tasks_async(job_prompts(jobs), batch_size=batch_size, deadline=deadline)
+            formatted = [decorate_task(job[1], tasks[str(i)], has_og_target_date, has_comments, **job[2])
+                         for i, job in enumerate(jobs)]
+        with metrics.stage('assemble_ppp'):
+            report = assemble_ppp(jobs, formatted)
+        await asyncio.to_thread(store_report, key, report)
+        return report
 
-        # calling openai
-        return progress_output, plans_output, problems_output
+    except Exception as ppp_error:
+        print(f"Error: {ppp_error}")
+        raise
+
+
+async def stream_ppp_async(workbook, audience, pg=None, batch_size=LLM_BATCH_SIZE):
+    """stream_ppp for the async server, an async generator of the same frames"""
+    try:
+        deadline = report_deadline()
+        data, key, cached = await asyncio.to_thread(lookup_report, workbook, audience, pg)
+        if cached is not None:
+            yield 'report', cached
+            return
+        jobs, has_og_target_date, has_comments = await asyncio.to_thread(read_tasks, data, audience, pg)
+
+        formatted = [None] * len(jobs)
+        pending = [asyncio.ensure_future(summarize_tasks_async(batch, batch_size=batch_size, deadline=deadline))
+                   for batch in prompt_batches(job_prompts(jobs), batch_size)]
+        try:
+            for next_batch in asyncio.as_completed(pending):
+                for task_id, task in (await next_batch).items():
+                    i = int(task_id)
+                    formatted[i] = decorate_task(jobs[i][1], task, has_og_target_date, has_comments, **jobs[i][2])
+                    yield 'task', jobs[i][0], formatted[i][0], formatted[i][1]
+        finally:  # a closed generator (e.g. client went away) cancels the tasks still waiting on openai
+            for pending_task in pending:
+                pending_task.cancel()
+        report = assemble_ppp(jobs, formatted)
+        await asyncio.to_thread(store_report, key, report)
+        yield 'report', report
 
     except Exception as ppp_error:
         print(f"Error: {ppp_error}")
-        return str(ppp_error)
+        raise
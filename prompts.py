@@ -0,0 +1,64 @@
+import html
+import pandas as pd
+from config import PROMPT_FIELDS, PROMPT_FIELD_MAX_TOKENS
+from llm import estimate_tokens
+
+
+def prompt_value(value):
+    """a task field as prompt text, or None when it is empty (NaN, NaT, blank)"""
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, float) and value.is_integer():  # pandas reads integer columns with blanks as floats
+        value = int(value)
+    text = ' '.join(str(value).split())  # one line, no runs of whitespace
+    return text or None
+
+
+def truncate(text, max_tokens):
+    """text cut down to roughly max_tokens tokens (see llm.estimate_tokens)"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max_tokens * 4].rsplit(' ', 1)[0] + '...'
+
+
+def build_task_prompt(row, fields=PROMPT_FIELDS, max_tokens=PROMPT_FIELD_MAX_TOKENS):
+    """the task information sent to openai: one '- Field: value' line (like the example in the system prompt)
+    for every field in fields the row has a value for, each cut down to max_tokens"""
+    lines = []
+    for field in fields:
+        text = prompt_value(row.get(field))
+        if text is not None:
+            lines.append(f"- {field}: {truncate(text, max_tokens)}")
+    return '\n'.join(lines)
+
+
+def log_prompt_tokens(rows, prompts):
+    """prints the estimated prompt tokens of the tasks' rows as dicts (what was sent before prompts were
+    compacted) vs the built prompts. rows hold the columns that were read: every column for generatePPP,
+    only SHEET_COLUMNS for mondayPPP, where 'before' is therefore a lower bound"""
+    before = sum(estimate_tokens(dict(row)) for row in rows)
+    after = sum(estimate_tokens(prompt) for prompt in prompts)
+    print(f"Task prompts: ~{before} tokens before compaction (dict(row)), ~{after} tokens sent "
+          f"({len(prompts)} task(s))")
+
+
+def mark_fallback(task_html):
+    """task html formatted locally rather than by openai, marked with the fallback class (see has_fallbacks)"""
+    return f"<span class='fallback' title='Not summarized by openai'>{task_html}</span>"
+
+
+def fallback_task(row):
+    """a task formatted locally, for when openai didn't format it in time: '<b>GOAL</b>: SUMMARY [ASSIGNEE]'
+    straight from its Department, Name and DRI"""
+    goal = prompt_value(row.get('Department')) or 'General'
+    summary = prompt_value(row.get('Name')) or 'Untitled task'
+    assignee = prompt_value(row.get('DRI')) or 'Unassigned'
+    return mark_fallback(f"<b>{html.escape(goal)}</b>: {html.escape(summary)} "
+                         f"<span class='assignee'>[{html.escape(assignee)}]</span>")
+
+
+def has_fallbacks(html):
+    """whether report html has tasks formatted by fallback_task"""
+    return "class='fallback'" in html
@@ -0,0 +1,129 @@
+import argparse
+import io
+import random
+from datetime import date, timedelta
+import pandas as pd
+from openpyxl import Workbook
+
+STATUSES = ['Working', 'Committed', 'Completed - Partial', 'Completed', 'Blocked', 'Soft Commit', 'Deprioritized',
+            'Canceled', 'Review', None]
+DEPARTMENTS = ['Sales', 'Support', 'Internship Program', 'Marketing', 'Finance', 'IT']
+DRIS = ['Program Lead', 'Ops Manager', 'Sales Director', 'Support Lead', 'Finance Partner']
+AUDIENCES = ['Everyone', 'Natalie']
+# board columns, including some the PPP never reads
+COLUMNS = ['Name', 'Subitems', 'DRI', 'Status', 'Timeline', 'Completed Date', 'Audience', 'Department', 'Comments',
+           'Item ID', 'Priority', 'Budget', 'Notes']
+GROUPS = ['Committed', 'Review', 'Closed']  # titles of the groups after the first are dropped as non-task rows
+
+
+def timeline_cells(rows, seed=0):
+    """Timeline cells shaped like a Monday export: blanks, single dates, comma separated dates and date ranges"""
+    rng = random.Random(seed)
+    start = date.today() - timedelta(days=180)
+
+    def day():
+        return (start + timedelta(days=rng.randrange(360))).isoformat()
+
+    cells = []
+    for _ in range(rows):
+        kind = rng.random()
+        if kind < 0.15:
+            cells.append(None)
+        elif kind < 0.2:
+            cells.append('')
+        elif kind < 0.6:
+            cells.append(day())
+        elif kind < 0.85:
+            cells.append(', '.join(day() for _ in range(rng.randint(2, 6))))
+        else:
+            cells.append(f"{day()} - {day()}")
+    return pd.Series(cells, dtype=object)
+
+
+def task_record(i, rng, timeline):
+    """one task row of a board"""
+    completed = date.today() - timedelta(days=rng.randrange(-30, 30))
+    return {
+        'Name': f"Task {i}",
+        'Subitems': ', '.join(f"Subitem {n}" for n in range(rng.randint(0, 4))),
+        'DRI': rng.choice(DRIS),
+        'Status': rng.choice(STATUSES),
+        'Timeline': timeline,
+        'Completed Date': completed.strftime('%m/%d/%Y') if rng.random() < 0.5 else None,
+        'Audience': rng.choice(AUDIENCES),
+        'Department': rng.choice(DEPARTMENTS),
+        'Comments': rng.choice([None, 'waiting on legal', 'vendor delay']),
+        'Item ID': 1000000 + i,
+        'Priority': rng.choice(['High', 'Medium', 'Low']),
+        'Budget': rng.randrange(100, 100000),
+        'Notes': rng.choice([None, 'see deck', 'tracked in jira'])
+    }
+
+
+def board_frame(rows, seed=0):
+    """a parsed Monday board export: tasks mixed with the header, subitem and blank rows read_sheet drops"""
+    rng = random.Random(seed)
+    timelines = timeline_cells(rows, seed)
+    records = []
+    for i in range(rows):
+        if rng.random() < 0.03:
+            records.append({'Name': rng.choice(['Subitems', 'Name', 'Review', 'Closed', '', None])})
+        else:
+            records.append(task_record(i, rng, timelines[i]))
+    return pd.DataFrame.from_records(records, columns=COLUMNS)
+
+
+def board_rows(rows, seed=0):
+    """the rows of a Monday board export sheet, in the layout read_sheet expects (skiprows=4):
+    board name, board description, a blank spacer and the first group's name, then for every group
+    a header row, its tasks (some followed by a 'Subitems' header and subitem rows) and a blank row"""
+    rng = random.Random(seed)
+    timelines = timeline_cells(rows, seed)
+    yield ['Synthetic Review Portfolio']
+    yield ['A high level overview of all your upcoming, current and completed projects.']
+    yield []
+    group_size = max(1, rows // len(GROUPS))
+    for i in range(rows):
+        if i % group_size == 0:
+            if i:
+                yield []
+                yield [GROUPS[(i // group_size) % len(GROUPS)]]
+            else:
+                yield [GROUPS[0]]
+            yield COLUMNS
+        yield [task_record(i, rng, timelines[i])[column] for column in COLUMNS]
+        if rng.random() < 0.1:  # subitems of the task, Name is blank
+            yield ['Subitems'] + COLUMNS[1:]
+            for n in range(rng.randint(1, 3)):
+                yield [None, f"Subitem {n} of task {i}", rng.choice(DRIS), rng.choice(STATUSES)]
+
+
+def write_workbook(rows, sheets=1, seed=0, path=None):
+    """a synthetic Monday board export with sheets sheets of rows tasks each ('Sheet1', 'Sheet2', ...) --
+    saved to path when given, returns the workbook's contents"""
+    workbook = Workbook(write_only=True)
+    for sheet in range(sheets):
+        worksheet = workbook.create_sheet(f"Sheet{sheet + 1}")
+        for row in board_rows(rows, seed + sheet):
+            worksheet.append(row)
+    output = io.BytesIO()
+    workbook.save(output)
+    data = output.getvalue()
+    if path:
+        with open(path, 'wb') as workbook_file:
+            workbook_file.write(data)
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='writes a synthetic Monday.com board export')
+    parser.add_argument('path')
+    parser.add_argument('--rows', type=int, default=1000, help='tasks per sheet')
+    parser.add_argument('--sheets', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_workbook(args.rows, sheets=args.sheets, seed=args.seed, path=args.path)
+
+
+if __name__ == '__main__':
+    main()
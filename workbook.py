@@ -0,0 +1,103 @@
+import hashlib
+import os
+import re
+import threading
+import uuid
+import pandas as pd
+
+try:
+    import pyarrow  # stores cached sheets as feather (see requirements.txt), without it sheets aren't cached
+except ImportError:
+    pyarrow = None
+
+
+def read_workbook(workbook):
+    """the bytes of an uploaded workbook, given its contents, a file-like object or a path"""
+    if isinstance(workbook, bytes):
+        return workbook
+    if hasattr(workbook, 'read'):
+        return workbook.read()
+    with open(workbook, 'rb') as workbook_file:
+        return workbook_file.read()
+
+
+def board_name(filename):
+    """the board an export's file name belongs to -- Monday appends a timestamp to every export
+    ('24Q3_Review_Portfolio_1718301234.xlsx'), so exports of the same board share a name"""
+    stem = os.path.splitext(os.path.basename(filename or ''))[0]
+    return re.sub(r'[_\s-]*\d{9,}$', '', stem) or stem
+
+
+def workbook_hash(data):
+    """content hash identifying a workbook no matter what the upload was called"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class SheetCache:
+    """parsed sheets as feather files in a local directory, keeping the max_entries most recently used --
+    nothing is cached without pyarrow, or for a sheet feather can't store (e.g. a column mixing numbers and text)"""
+
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.feather")
+
+    def get(self, key):
+        """the cached DataFrame for key, or None"""
+        df = None
+        if pyarrow is not None:
+            try:
+                df = pd.read_feather(self.path(key))
+                os.utime(self.path(key))  # mark as recently used
+            except FileNotFoundError:  # not cached (or just evicted)
+                df = None
+        with self.lock:
+            if df is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return df
+
+    def put(self, key, df):
+        if pyarrow is None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = os.path.join(self.directory, f".{uuid.uuid4().hex}.tmp")  # readers never see half a file
+        try:
+            df.reset_index(drop=True).to_feather(temp_path)
+            os.replace(temp_path, self.path(key))
+        except (pyarrow.ArrowException, ValueError, TypeError):  # e.g. a column mixing numbers and text
+            pass
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            self.evict()
+
+    def evict(self):
+        """removes the least recently used sheets beyond max_entries"""
+        with self.lock:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.feather')]
+            entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+            for entry in entries[self.max_entries:]:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:  # another worker got there first
+                    pass
+
+    def clear(self):
+        """removes every cached sheet, e.g. to time cold runs"""
+        with self.lock:
+            if not os.path.isdir(self.directory):
+                return
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(('.feather', '.pkl')):
+                    os.remove(entry.path)
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}